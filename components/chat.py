@@ -45,7 +45,8 @@ def render_pdf_chat(chapters_data, provider, model_name):
                             google_client=st.session_state.google_client,
                             openrouter_client=st.session_state.openrouter_client,
                             zai_client=st.session_state.zai_client,
-                            direct_chat=False
+                            direct_chat=False,
+                            history_state=st.session_state.setdefault("pdf_history_state", {})
                         )
                     st.markdown(response)
             
@@ -84,7 +85,8 @@ def render_general_chat(show_general_chat, provider, model_name):
                             google_client=st.session_state.google_client,
                             openrouter_client=st.session_state.openrouter_client,
                             zai_client=st.session_state.zai_client,
-                            direct_chat=True
+                            direct_chat=True,
+                            history_state=st.session_state.setdefault("general_history_state", {})
                         )
                     st.markdown(response)
             
@@ -6,11 +6,12 @@ import pandas as pd
 import logging
 import re
 from utils.pdf_processor import extract_text_from_pdf, clean_text, recursive_character_text_splitter
-from utils.llm_handler import process_chunk, generate_chapter_summary, detect_chapters_in_text, split_text_by_chapters
+from utils.llm_handler import process_chunk, process_chunks_batch, generate_chapter_summary, generate_chapter_summaries_parallel, detect_chapters_in_text, split_text_by_chapters
 from utils.data_processing import robust_csv_parse, push_card_to_anki, deduplicate_cards, check_ankiconnect, format_cards_for_ankiconnect
 import streamlit.components.v1 as components
 import json
 from utils.rag import SQLiteVectorStore
+from utils.dedup import DedupIndex
 import html
 
 logger = logging.getLogger(__name__)
@@ -139,6 +140,8 @@ def _validate_pdf_file(uploaded_file) -> bool:
 # Constants
 MAX_FILE_SIZE_MB = 50
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+CHUNK_CONCURRENCY = 4  # Parallel process_chunk calls per chapter
+SUMMARY_CONCURRENCY = 4  # Parallel chapter summary calls per file
 
 def _process_files(uploaded_files, detect_chapters, chunk_size, summary_model, skip_summary=False, progress_text=None):
     """
@@ -186,20 +189,20 @@ def _process_files(uploaded_files, detect_chapters, chunk_size, summary_model, s
                     
                     if chapter_texts:
                         # Successfully split into chapters
-                        for ch_data in chapter_texts:
+                        # Use robust cleaner
+                        cleaned_chapters = [clean_text(ch_data['text']) for ch_data in chapter_texts]
+                        
+                        ch_summaries = ["Summary skipped (Fast Track)"] * len(chapter_texts)
+                        if not skip_summary:
+                            progress_text.text(f"Summarizing {len(chapter_texts)} chapters of {name}...")
+                            try:
+                                ch_summaries = generate_chapter_summaries_parallel(cleaned_chapters, google_client=st.session_state.google_client, openrouter_client=st.session_state.openrouter_client, zai_client=st.session_state.zai_client, model_name=summary_model, max_workers=SUMMARY_CONCURRENCY)
+                            except Exception as e:
+                                logger.warning(f"Summary generation failed for {name}: {e}")
+                                ch_summaries = ["(Summary generation failed)"] * len(chapter_texts)
+                        
+                        for ch_data, ch_text_cleaned, ch_summary in zip(chapter_texts, cleaned_chapters, ch_summaries):
                             ch_title = ch_data['title']
-                            ch_text = ch_data['text']
-                            
-                            # Use robust cleaner
-                            ch_text_cleaned = clean_text(ch_text)
-                            
-                            ch_summary = "Summary skipped (Fast Track)"
-                            if not skip_summary:
-                                try:
-                                    ch_summary = generate_chapter_summary(ch_text_cleaned, google_client=st.session_state.google_client, openrouter_client=st.session_state.openrouter_client, zai_client=st.session_state.zai_client, model_name=summary_model)
-                                except Exception as e:
-                                    logger.warning(f"Summary generation failed for {ch_title}: {e}")
-                                    ch_summary = "(Summary generation failed)"
                             
                             # Index for RAG
                             chunks = recursive_character_text_splitter(ch_text_cleaned, chunk_size=2000)
@@ -242,7 +245,7 @@ def _process_files(uploaded_files, detect_chapters, chunk_size, summary_model, s
     st.toast(f"Processed {len(file_chapters)} {'chapters' if detect_chapters else 'files'}", icon="📚")
     progress_text.empty()
 
-def _generate_cards(provider, model_name, chunk_size, card_length, card_density, enable_highlighting, custom_prompt, formatting_mode, deck_type, base_deck_name, developer_mode=False, progress_bar=None, status_text=None):
+def _generate_cards(provider, model_name, chunk_size, card_length, card_density, enable_highlighting, custom_prompt, formatting_mode, deck_type, base_deck_name, developer_mode=False, progress_bar=None, status_text=None, drop_near_duplicates=False):
     """
     Helper to generate cards from processed chapters data.
     """
@@ -260,6 +263,12 @@ def _generate_cards(provider, model_name, chunk_size, card_length, card_density,
         
         if 'generated_questions' not in st.session_state:
             st.session_state['generated_questions'] = []
+        # Optionally drop near-duplicate questions locally instead of listing past topics in every prompt
+        dedup_index = None
+        if drop_near_duplicates:
+            dedup_index = DedupIndex()
+            for question in st.session_state['generated_questions']:
+                dedup_index.add(question)
         
         for ch_idx, chapter in enumerate(st.session_state['chapters_data']):
             raw_text = chapter['text']
@@ -267,26 +276,26 @@ def _generate_cards(provider, model_name, chunk_size, card_length, card_density,
             chunks = recursive_character_text_splitter(cleaned, chunk_size=chunk_size)
             
             status_text.text(f"Processing {chapter['title']}...")
+            progress_bar.progress(min(ch_idx / total_chapters, 1.0))
             
-            for chunk_idx, chunk in enumerate(chunks):
-                current_progress = (ch_idx + (chunk_idx / len(chunks))) / total_chapters
-                progress_bar.progress(min(current_progress, 1.0))
-                
-                csv_chunk = process_chunk(
-                    chunk, 
-                    google_client=st.session_state.google_client,
-                    openrouter_client=st.session_state.openrouter_client,
-                    zai_client=st.session_state.zai_client,
-                    provider=provider_code,
-                    model_name=model_name,
-                    card_length=card_length,
-                    card_density=card_density,
-                    enable_highlighting=enable_highlighting,
-                    custom_prompt=custom_prompt,
-                    formatting_mode=formatting_mode,
-                    existing_topics=st.session_state['generated_questions']
-                )
-                
+            # Chunks of a chapter are generated concurrently; the shared index (if any) drops near-duplicates
+            csv_chunks = process_chunks_batch(
+                chunks,
+                max_workers=CHUNK_CONCURRENCY,
+                google_client=st.session_state.google_client,
+                openrouter_client=st.session_state.openrouter_client,
+                zai_client=st.session_state.zai_client,
+                provider=provider_code,
+                model_name=model_name,
+                card_length=card_length,
+                card_density=card_density,
+                enable_highlighting=enable_highlighting,
+                custom_prompt=custom_prompt,
+                formatting_mode=formatting_mode,
+                dedup_index=dedup_index
+            )
+            
+            for csv_chunk in csv_chunks:
                 if csv_chunk and not csv_chunk.startswith("Error"):
                     try:
                         df_chunk = robust_csv_parse(csv_chunk)
@@ -377,6 +386,7 @@ def render_generator(config):
         deck_type = st.radio("Deck Organization", ["Subdecks (Base::Item)", "Tags Only (Deck: Base, Tag: Item)", "Both"], help="Organization structure.")
         formatting_mode = st.radio("Card Formatting", ["Basic + MathJax", "Markdown", "Legacy LaTeX"], index=0, help="Basic + MathJax = works with default Anki. Markdown = styled text. Legacy LaTeX = [latex]...[/latex] tags.")
         detect_chapters = st.toggle("Auto-Detect Chapters within PDFs", value=False, help="Uses AI to split each PDF into individual chapters for better deck organization.")
+        drop_near_duplicates = st.toggle("Drop Near-Duplicate Questions", value=False, help="Skips cards whose question nearly repeats an earlier one. Exact repeats are always removed.")
         
         # New Deck Name Field
         uploaded_files_preview = st.session_state.get("anki_uploader", [])
@@ -430,7 +440,8 @@ def render_generator(config):
                         base_deck_name=base_deck_name,
                         developer_mode=developer_mode,
                         progress_bar=gen_progress,
-                        status_text=gen_status
+                        status_text=gen_status,
+                        drop_near_duplicates=drop_near_duplicates
                     )
         
         # Show Data & Generate
@@ -459,7 +470,8 @@ def render_generator(config):
                     base_deck_name=base_deck_name,
                     developer_mode=developer_mode,
                     progress_bar=gen_progress,
-                    status_text=gen_status
+                    status_text=gen_status,
+                    drop_near_duplicates=drop_near_duplicates
                 )
 
             if 'result_df' in st.session_state:
@@ -276,7 +276,8 @@ def render_standalone_chat():
                         google_client=st.session_state.get('google_client'),
                         openrouter_client=st.session_state.get('openrouter_client'),
                         zai_client=st.session_state.get('zai_client'),
-                        direct_chat=not bool(context)
+                        direct_chat=not bool(context),
+                        history_state=st.session_state.setdefault("standalone_history_state", {})
                     )
                 st.markdown(response)
         
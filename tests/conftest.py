@@ -0,0 +1,14 @@
+"""
+Shared test fixtures.
+"""
+import pytest
+import utils.llm_cache as llm_cache
+
+@pytest.fixture(autouse=True)
+def memory_cache(monkeypatch):
+    """Use a fresh in-process LLM/embedding cache per test instead of the on-disk one."""
+    cache = {}
+    monkeypatch.setattr(llm_cache, "_get_cache", lambda: cache)
+    monkeypatch.setattr(llm_cache, "_stats", {"hits": 0, "misses": 0})
+    monkeypatch.setattr(llm_cache, "_embeddings", llm_cache.OrderedDict())
+    return cache
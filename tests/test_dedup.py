@@ -0,0 +1,47 @@
+"""
+Tests for the DedupIndex near-duplicate filter.
+"""
+from utils.dedup import DedupIndex
+
+def test_add_rejects_near_duplicates():
+    index = DedupIndex()
+    assert index.add("What is the mechanism of action of ACE inhibitors?")
+    assert not index.add("What is the mechanism of action of ACE inhibitors")
+    assert not index.add("what is the MECHANISM of action of ACE-inhibitors?")
+    assert index.add("What are the side effects of ACE inhibitors?")
+    assert index.add("Which nerve innervates the deltoid muscle?")
+    assert len(index) == 3
+
+def test_is_duplicate_does_not_index():
+    index = DedupIndex()
+    assert not index.is_duplicate("Define tachycardia")
+    assert len(index) == 0
+    index.add("Define tachycardia")
+    assert index.is_duplicate("Define tachycardia.")
+
+def test_filter_tsv_drops_repeated_fronts():
+    index = DedupIndex()
+    index.add("What is the normal adult heart rate?")
+    tsv = (
+        '"What is the normal adult heart rate?"\t"60-100 bpm"\n'
+        '"Define bradycardia"\t"HR < 60"\n'
+        '"Define bradycardia."\t"Heart rate below 60"\n'
+        'not a card line'
+    )
+    assert index.filter_tsv(tsv) == '"Define bradycardia"\t"HR < 60"\nnot a card line'
+
+def test_keeps_questions_differing_in_one_word():
+    index = DedupIndex()
+    assert index.add("type 2 vs type 1 diabetes treatment")
+    assert index.add("type 1 vs type 2 diabetes treatment")
+    assert index.add("pneumonia in adults")
+    assert index.add("pneumonia in children")
+    assert len(index) == 4
+
+def test_filter_tsv_logs_dropped_rows(caplog):
+    import logging
+    index = DedupIndex()
+    index.add("Define tachycardia")
+    with caplog.at_level(logging.INFO, logger="utils.dedup"):
+        assert index.filter_tsv('"Define tachycardia."\t"HR > 100"') == ""
+    assert "Define tachycardia." in caplog.text
@@ -0,0 +1,64 @@
+"""
+Tests for the exact-match LLM response cache.
+"""
+import pytest
+import utils.llm_cache as llm_cache
+
+def test_cached_call_skips_repeat_and_failed_calls(memory_cache):
+    calls = []
+    def generate():
+        calls.append(1)
+        return '["a.pdf", "b.pdf"]'
+
+    key = llm_cache.make_key(m="gemma-3-27b-it", t=0.0, p="prompt")
+    assert llm_cache.cached_call(key, generate) == '["a.pdf", "b.pdf"]'
+    assert llm_cache.cached_call(key, generate) == '["a.pdf", "b.pdf"]'
+    assert len(calls) == 1
+
+    def failing():
+        raise RuntimeError("429")
+    with pytest.raises(RuntimeError):
+        llm_cache.cached_call(llm_cache.make_key(m="other", p="prompt"), failing)
+    assert len(memory_cache) == 1
+    assert llm_cache.cache_stats() == {"hits": 1, "misses": 2, "size": 1}
+
+def test_cached_call_expires_entries(memory_cache):
+    key = llm_cache.make_key(p="prompt")
+    llm_cache.cached_call(key, lambda: "old", ttl=-1)
+    assert llm_cache.cached_call(key, lambda: "new") == "new"
+
+def test_llm_cache_decorator_ignores_client():
+    calls = []
+    @llm_cache.llm_cache()
+    def generate(model_name, system_instruction, user_content, client):
+        calls.append(client)
+        return f"{model_name}:{user_content}"
+
+    assert generate("m", "sys", "hello", object()) == "m:hello"
+    assert generate("m", "sys", "hello", object()) == "m:hello"
+    assert len(calls) == 1
+    generate("m", "sys", "hello", object(), use_cache=False)
+    generate("m", "other sys", "hello", object())
+    assert len(calls) == 3
+
+def test_cached_embeddings_only_embeds_misses(monkeypatch):
+    monkeypatch.setattr(llm_cache, "EMBEDDING_MEMORY_ENTRIES", 2)
+    requested = []
+    def embed_missing(indices):
+        requested.append(list(indices))
+        return [[] if i == 3 else [float(i), 0.5] for i in indices]
+
+    keys = ["a", "b", "a", "fails"]
+    assert llm_cache.cached_embeddings(keys, embed_missing) == [[0.0, 0.5], [1.0, 0.5], [0.0, 0.5], []]
+    assert llm_cache.cached_embeddings(["b", "c"], embed_missing) == [[1.0, 0.5], [1.0, 0.5]]
+    assert requested == [[0, 1, 3], [1]]
+    # Least recently used key was evicted from the bounded memory cache
+    assert list(llm_cache._embeddings) == ["b", "c"]
+
+def test_stats_count_every_call_across_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    keys = [f"k{i % 10}" for i in range(2000)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda key: llm_cache.cached_call(key, lambda: "v"), keys))
+    stats = llm_cache.cache_stats()
+    assert stats["hits"] + stats["misses"] == len(keys)
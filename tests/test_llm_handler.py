@@ -0,0 +1,390 @@
+"""
+Tests for LLM handler text utilities (no network calls).
+"""
+import pytest
+from types import SimpleNamespace
+import utils.llm_handler as llm_handler
+from utils.llm_handler import split_text_by_chapters
+
+SAMPLE_TEXT = (
+    "Contents\n"
+    + "CHAPTER 1: Cardiology " + "heart " * 40
+    + "Chapter 2: Nephrology " + "kidney " * 40
+    + "Chapter 3: Neurology " + "brain " * 40
+)
+SAMPLE_CHAPTERS = [
+    {"title": "Chapter 1: Cardiology"},
+    {"title": "Chapter 2: Nephrology"},
+    {"title": "Chapter 3: Neurology"},
+]
+
+@pytest.fixture(params=["automaton", "regex"])
+def search_backend(request, monkeypatch):
+    """Run chapter splitting with and without the optional automaton."""
+    if request.param == "regex":
+        monkeypatch.setattr(llm_handler, "ahocorasick", None)
+    elif llm_handler.ahocorasick is None:
+        pytest.skip("pyahocorasick not installed")
+    return request.param
+
+def test_split_text_by_chapters(search_backend):
+    splits = split_text_by_chapters(SAMPLE_TEXT, SAMPLE_CHAPTERS)
+    assert [s["title"] for s in splits] == [c["title"] for c in SAMPLE_CHAPTERS]
+    assert splits[0]["text"].startswith("CHAPTER 1: Cardiology")
+    assert "kidney" not in splits[0]["text"]
+    assert splits[1]["text"].startswith("Chapter 2: Nephrology")
+    assert splits[2]["text"].endswith("brain ")
+
+def test_split_text_by_chapters_unreliable(search_backend):
+    chapters = [{"title": "Missing A"}, {"title": "Missing B"}, {"title": "Missing C"}, {"title": "Chapter 3: Neurology"}]
+    assert split_text_by_chapters(SAMPLE_TEXT, chapters) == []
+    assert split_text_by_chapters(SAMPLE_TEXT, []) == []
+
+def test_find_title_occurrences_overlapping_prefixes(search_backend):
+    text = "Part A intro. part a1 details. PART A"
+    occ = llm_handler._find_title_occurrences(text, ["part a", "Part A1", "missing", "PART A"])
+    assert occ == [[0, 14, 31], [14], [], [0, 14, 31]]
+
+def test_process_chunks_batch_preserves_order(monkeypatch):
+    calls = []
+    def fake_process_chunk(text_chunk, **kwargs):
+        calls.append(kwargs)
+        return f"out:{text_chunk}"
+    monkeypatch.setattr(llm_handler, "process_chunk", fake_process_chunk)
+
+    chunks = ["x" * n for n in (50, 5, 500, 1, 20, 300)]
+    results = llm_handler.process_chunks_batch(chunks, provider="google")
+    assert results == [f"out:{c}" for c in chunks]
+    assert all(kw == {"provider": "google"} for kw in calls)
+
+def test_process_chunks_batch_submits_longest_first(monkeypatch):
+    calls = []
+    monkeypatch.setattr(llm_handler, "process_chunk", lambda text_chunk, **kwargs: calls.append(text_chunk) or text_chunk)
+
+    chunks = ["x" * n for n in (50, 5, 500, 1)]
+    assert llm_handler.process_chunks_batch(chunks, max_workers=1) == chunks
+    assert calls == sorted(chunks, key=len, reverse=True)
+
+def test_get_embeddings_batches_requests(monkeypatch):
+    class FakeModels:
+        def __init__(self):
+            self.batches = []
+        def embed_content(self, model, contents):
+            self.batches.append(list(contents))
+            return SimpleNamespace(embeddings=[SimpleNamespace(values=[float(len(t))]) for t in contents])
+
+    models = FakeModels()
+    client = {"primary": SimpleNamespace(models=models), "fallbacks": []}
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+
+    assert llm_handler.get_embeddings(texts, google_client=client, batch_size=2) == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    # Batches may complete in any order
+    assert sorted(models.batches) == [["a", "bb"], ["ccc", "dddd"], ["eeeee"]]
+    assert llm_handler.get_embedding("xyz", google_client=client) == [3.0]
+    # Repeated texts come from the embedding cache
+    assert llm_handler.get_embeddings(["bb", "xyz", "ffffff"], google_client=client) == [[2.0], [3.0], [6.0]]
+    assert models.batches[-1] == ["ffffff"]
+    assert llm_handler.get_embeddings(texts, google_client=None) == [[]] * 5
+
+def test_truncate_tokens_character_fallback(monkeypatch):
+    monkeypatch.setattr(llm_handler, "_get_token_encoding", lambda: None)
+    llm_handler._truncate_tokens.cache_clear()
+    try:
+        text = "word " * 100
+        assert llm_handler._truncate_tokens(text, 10) == text[:10 * llm_handler.CHARS_PER_TOKEN]
+        assert llm_handler._truncate_tokens("short", 10) == "short"
+    finally:
+        llm_handler._truncate_tokens.cache_clear()
+
+def test_clean_tsv_strips_fences_and_noise():
+    reply = 'Here are your cards:\n```tsv\n"Q1"\t"A1"\nnot a card\n  "Q2"\t"A2"  \n```\nDone.'
+    assert llm_handler._clean_tsv(reply) == '"Q1"\t"A1"\n"Q2"\t"A2"'
+    # Without any card-like lines the stripped text is returned unchanged
+    assert llm_handler._clean_tsv("  no cards here  ") == "no cards here"
+
+def test_to_content_reuses_conversion():
+    messages = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    first = [llm_handler._to_content(m) for m in messages]
+    second = [llm_handler._to_content(m) for m in messages]
+    assert [c.role for c in first] == ["user", "model"]
+    assert all(a is b for a, b in zip(first, second))
+
+    # An edited message is converted again
+    messages[0]["content"] = "Hi again"
+    assert llm_handler._to_content(messages[0]).parts[0].text == "Hi again"
+
+def test_generate_text_with_retry_caches_low_temperature_only(monkeypatch):
+    calls = []
+    def fake_generate(model_name, contents, config, client_config, fallback_to_flash_lite=True):
+        calls.append(config.temperature)
+        return SimpleNamespace(text="summary")
+    monkeypatch.setattr(llm_handler, "_generate_with_retry", fake_generate)
+
+    for _ in range(2):
+        llm_handler._generate_text_with_retry("m", "prompt", llm_handler.types.GenerateContentConfig(temperature=0.2), {})
+        llm_handler._generate_text_with_retry("m", "prompt", llm_handler.types.GenerateContentConfig(temperature=0.7), {})
+    assert calls == [0.2, 0.7, 0.7]
+
+def test_token_bucket_only_sleeps_when_empty(monkeypatch):
+    clock = {"now": 100.0}
+    sleeps = []
+    def fake_sleep(seconds):
+        sleeps.append(round(seconds, 3))
+        clock["now"] += seconds
+    monkeypatch.setattr(llm_handler.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(llm_handler.time, "sleep", fake_sleep)
+
+    bucket = llm_handler.TokenBucket(rate_per_sec=0.5, capacity=1)
+    bucket.acquire()
+    assert sleeps == []
+    bucket.acquire()
+    assert sleeps == [2.0]
+
+    # After an idle period the next call goes straight through
+    clock["now"] += 10
+    bucket.acquire()
+    assert sleeps == [2.0]
+
+def test_fallback_clients_built_only_after_rate_limit(monkeypatch):
+    built = []
+    def fake_client_for(key):
+        built.append(key)
+        return SimpleNamespace(models=SimpleNamespace(generate_content=lambda **kw: SimpleNamespace(text=f"from {key}")))
+    def rate_limited(**kwargs):
+        raise RuntimeError("429 RESOURCE_EXHAUSTED")
+    monkeypatch.setattr(llm_handler, "_client_for", fake_client_for)
+    monkeypatch.setattr(llm_handler, "rate_limit_delay", lambda model_name: None)
+    monkeypatch.setattr(llm_handler.time, "sleep", lambda seconds: None)
+
+    config = llm_handler.configure_gemini("primary-key", fallback_keys=[" key-2 ", "", "key-3"])
+    assert config["fallbacks"] == ["key-2", "key-3"]
+    assert config["primary_key"] == "primary-key"
+    assert built == ["primary-key"]
+
+    config["primary"] = SimpleNamespace(models=SimpleNamespace(generate_content=rate_limited))
+    response = llm_handler._generate_with_retry("m", "prompt", None, config, fallback_to_flash_lite=False)
+    assert response.text == "from key-2"
+    assert built == ["primary-key", "key-2"]
+
+def test_card_prompt_keeps_static_prefix_first(monkeypatch):
+    monkeypatch.setattr(llm_handler, "rate_limit_delay", lambda model_name: None)
+    sent = []
+    class FakeCompletions:
+        def create(self, **kwargs):
+            sent.append(kwargs["messages"])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='"Q"\t"A"'))])
+    client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+
+    llm_handler.process_chunk("chunk one", openrouter_client=client, provider="openrouter", model_name="x/y", card_density="Low")
+    llm_handler.process_chunk("chunk two", openrouter_client=client, provider="openrouter", model_name="x/y", existing_topics=["Topic"])
+    assert [m["role"] for m in sent[0]] == ["system", "system", "user"]
+    assert sent[0][0] == sent[1][0] == {"role": "system", "content": llm_handler._PREFIX_BY_MODE["Markdown/HTML"]}
+    assert "DENSITY = LOW" in sent[0][1]["content"]
+    assert "Topic" in sent[1][1]["content"]
+
+def test_process_chunk_with_dedup_index_filters_locally(monkeypatch):
+    from utils.dedup import DedupIndex
+    prompts = []
+    def fake_openrouter(model_name, system_instruction, user_content, client, extra_instruction="", **kwargs):
+        prompts.append(extra_instruction)
+        return '"Define sepsis"\t"A"\n"Define shock"\t"B"'
+    monkeypatch.setattr(llm_handler, "_generate_with_openrouter", fake_openrouter)
+
+    index = DedupIndex()
+    index.add("Define sepsis")
+    result = llm_handler.process_chunk("chunk", provider="openrouter", existing_topics=["Define sepsis"], dedup_index=index)
+    assert result == '"Define shock"\t"B"'
+    assert "ANTI-DUPLICATE" not in prompts[0]
+
+def test_client_cache_is_bounded_and_keyed_by_hash(monkeypatch):
+    built = []
+    def fake_client(api_key, http_options=None):
+        built.append(api_key)
+        return SimpleNamespace(api_key=api_key)
+    monkeypatch.setattr(llm_handler.genai, "Client", fake_client)
+    monkeypatch.setattr(llm_handler, "_CLIENTS", llm_handler.OrderedDict())
+    monkeypatch.setattr(llm_handler, "GEMINI_CLIENT_CACHE_SIZE", 2)
+
+    first = llm_handler._client_for("key-1")
+    assert llm_handler._client_for("key-1") is first
+    llm_handler._client_for("key-2")
+    llm_handler._client_for("key-3")
+    assert len(llm_handler._CLIENTS) == 2
+    assert all(not key.startswith("key-") for key in llm_handler._CLIENTS)
+    llm_handler._client_for("key-1")
+    assert built == ["key-1", "key-2", "key-3", "key-1"]
+
+def test_rate_limited_key_is_tried_last(monkeypatch):
+    calls = []
+    def client(name, fail):
+        def generate_content(**kwargs):
+            calls.append(name)
+            if fail:
+                raise RuntimeError("429 RESOURCE_EXHAUSTED")
+            return SimpleNamespace(text=name)
+        return SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(llm_handler, "_client_for", lambda key: client(key, fail=False))
+    monkeypatch.setattr(llm_handler, "rate_limit_delay", lambda model_name: None)
+    monkeypatch.setattr(llm_handler.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(llm_handler, "_KEY_COOLDOWNS", {})
+
+    config = {"primary": client("primary", fail=True), "primary_key": "primary", "fallbacks": ["key-2"]}
+    assert llm_handler._generate_with_retry("m", "p", None, config, fallback_to_flash_lite=False).text == "key-2"
+    assert llm_handler._generate_with_retry("m", "p", None, config, fallback_to_flash_lite=False).text == "key-2"
+    assert calls == ["primary", "key-2", "key-2"]
+
+    # Cooldowns follow the API key, not the client object
+    other = {"primary": config["primary"], "primary_key": "other", "fallbacks": ["key-2"]}
+    assert llm_handler._generate_with_retry("m", "p", None, other, fallback_to_flash_lite=False).text == "key-2"
+    assert calls[3:] == ["primary", "key-2"]
+    assert all(key not in ("primary", "other", "key-2") for key, _ in llm_handler._KEY_COOLDOWNS)
+
+def test_generate_with_retry_tries_each_combination_once(monkeypatch):
+    calls = []
+    sleeps = []
+    def failing_client(name):
+        def generate_content(model, **kwargs):
+            calls.append((name, model))
+            raise RuntimeError("429 RESOURCE_EXHAUSTED")
+        return SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(llm_handler, "_client_for", failing_client)
+    monkeypatch.setattr(llm_handler, "rate_limit_delay", lambda model_name: None)
+    monkeypatch.setattr(llm_handler.time, "sleep", sleeps.append)
+    monkeypatch.setattr(llm_handler, "_KEY_COOLDOWNS", {})
+
+    config = {"primary": failing_client("primary"), "fallbacks": ["key-2"]}
+    with pytest.raises(Exception, match="All attempts failed"):
+        llm_handler._generate_with_retry("m", "p", None, config)
+    models = ["m"] + [m for m in llm_handler.GOOGLE_FALLBACK_MODELS if m != "m"]
+    assert sorted(calls) == sorted((key, m) for m in models for key in ("primary", "key-2"))
+    # Backoff between models after transient failures, capped
+    assert [s for s in sleeps if s != 1] == [2, 4, 8, 10]
+
+def test_retry_on_api_error_uses_status_and_exception_type():
+    from google.genai import errors
+    assert llm_handler._retry_on_api_error(errors.APIError(429, {}))
+    assert llm_handler._retry_on_api_error(errors.APIError(504, {}))
+    assert not llm_handler._retry_on_api_error(errors.APIError(400, {"error": {"message": "timeout must be positive"}}))
+    assert llm_handler._retry_on_api_error(llm_handler.httpx.ReadTimeout("read timed out"))
+    assert not llm_handler._retry_on_api_error(ValueError("invalid timeout setting"))
+
+def test_generate_with_retry_does_not_repeat_permanent_errors(monkeypatch):
+    calls = []
+    def generate_content(**kwargs):
+        calls.append(kwargs["model"])
+        raise ValueError("400 INVALID_ARGUMENT")
+    monkeypatch.setattr(llm_handler, "rate_limit_delay", lambda model_name: None)
+    monkeypatch.setattr(llm_handler.time, "sleep", lambda seconds: None)
+
+    config = {"primary": SimpleNamespace(models=SimpleNamespace(generate_content=generate_content)), "fallbacks": []}
+    with pytest.raises(Exception, match="All attempts failed"):
+        llm_handler._generate_with_retry("m", "p", None, config, fallback_to_flash_lite=False)
+    assert calls == ["m"]
+
+def test_rag_system_prompt_built_once_per_context(monkeypatch):
+    truncations = []
+    def fake_truncate(text, max_tokens):
+        truncations.append(max_tokens)
+        return text[:max_tokens]
+    monkeypatch.setattr(llm_handler, "_truncate_tokens", fake_truncate)
+    llm_handler._rag_system_prompt.cache_clear()
+
+    context = "".join(["document text "] * 100)
+    first = llm_handler._rag_system_prompt(context, 20)
+    assert llm_handler._rag_system_prompt("".join(["document text "] * 100), 20) is first
+    assert "document text docume" in first
+    assert truncations == [20]
+    llm_handler._rag_system_prompt.cache_clear()
+
+def test_generate_chapter_summaries_parallel_keeps_order(monkeypatch):
+    monkeypatch.setattr(llm_handler, "generate_chapter_summary", lambda text, **kwargs: f"summary of {text} by {kwargs['model_name']}")
+    texts = ["ch1", "ch2", "ch3"]
+    assert llm_handler.generate_chapter_summaries_parallel(texts, model_name="m", max_workers=2) == [
+        "summary of ch1 by m", "summary of ch2 by m", "summary of ch3 by m"
+    ]
+    assert llm_handler.generate_chapter_summaries_parallel([]) == []
+
+def test_gemini_history_converts_only_new_messages(monkeypatch):
+    converted = []
+    def fake_to_content(message):
+        converted.append(message["content"])
+        return message["content"]
+    monkeypatch.setattr(llm_handler, "_to_content", fake_to_content)
+
+    state = {}
+    messages = [{"role": "user", "content": "Hi"}]
+    assert llm_handler._gemini_history(messages, state) == ["Hi"]
+    messages += [{"role": "assistant", "content": "Hello"}, {"role": "user", "content": "Next"}]
+    assert llm_handler._gemini_history(messages, state) == ["Hi", "Hello", "Next"]
+    assert converted == ["Hi", "Hello", "Next"]
+
+    # A new (cleared) conversation list is converted from scratch
+    assert llm_handler._gemini_history([{"role": "user", "content": "Fresh"}], state) == ["Fresh"]
+
+def test_model_chain_puts_requested_model_first():
+    assert llm_handler._model_chain("gemini-2.5-flash", "google") == (
+        "gemini-2.5-flash", "gemini-2.5-flash-lite", "gemini-3-flash", "gemma-3-27b-it"
+    )
+    assert llm_handler._model_chain("custom", "zai") == ("custom", "GLM-4.5-air")
+
+def test_process_chunk_splits_oversized_chunks(monkeypatch):
+    monkeypatch.setattr(llm_handler, "TARGET_CHUNK_TOKENS", 50)
+    monkeypatch.setattr(llm_handler, "_get_token_encoding", lambda: None)
+    sent = []
+    def fake_openrouter(model_name, system_instruction, user_content, client, **kwargs):
+        sent.append(user_content)
+        return f'"Q{len(sent)}"\t"A"'
+    monkeypatch.setattr(llm_handler, "_generate_with_openrouter", fake_openrouter)
+
+    text = "Sentence number one here. " * 20  # 520 chars, ~130 tokens
+    result = llm_handler.process_chunk(text, provider="openrouter", model_name="x/y")
+    assert len(sent) > 1
+    assert all(len(part) <= 50 * llm_handler.CHARS_PER_TOKEN for part in sent)
+    assert result == "\n".join(f'"Q{i}"\t"A"' for i in range(1, len(sent) + 1))
+
+def test_process_chunk_oversized_split_always_terminates(monkeypatch):
+    monkeypatch.setattr(llm_handler, "_get_token_encoding", lambda: None)
+    sent = []
+    def fake_openrouter(model_name, system_instruction, user_content, client, **kwargs):
+        sent.append(user_content)
+        return '"Q"\t"A"'
+    monkeypatch.setattr(llm_handler, "_generate_with_openrouter", fake_openrouter)
+
+    # Just over the budget: every part must come back within it
+    for text in ("word " * 6560, "x" * 32800):
+        sent.clear()
+        assert llm_handler.process_chunk(text, provider="openrouter", model_name="x/y").startswith('"Q"')
+        assert all(len(part) <= llm_handler.TARGET_CHUNK_TOKENS * llm_handler.CHARS_PER_TOKEN for part in sent)
+
+    # A splitter that cannot shrink the text falls back to truncation instead of recursing
+    monkeypatch.setattr(llm_handler, "recursive_character_text_splitter", lambda text, **kwargs: [text])
+    sent.clear()
+    assert llm_handler.process_chunk("x" * 40000, provider="openrouter", model_name="x/y") == '"Q"\t"A"'
+    assert sent == ["x" * (llm_handler.TARGET_CHUNK_TOKENS * llm_handler.CHARS_PER_TOKEN)]
+
+def test_process_chunk_uncached_unless_requested(monkeypatch):
+    calls = []
+    def fake_openrouter(model_name, system_instruction, user_content, client, **kwargs):
+        calls.append(kwargs.get("use_cache"))
+        return '"Q"\t"A"'
+    monkeypatch.setattr(llm_handler, "_generate_with_openrouter", fake_openrouter)
+
+    llm_handler.process_chunk("chunk", provider="openrouter", model_name="x/y")
+    llm_handler.process_chunk("chunk", provider="openrouter", model_name="x/y", use_cache=True)
+    llm_handler.process_chunk("chunk", provider="openrouter", model_name="x/y", use_cache=True, existing_topics=["Q"])
+    assert calls == [False, True, False]
+
+def test_worker_threads_get_streamlit_context(monkeypatch):
+    import sys
+    import threading
+    attached = []
+    fake = SimpleNamespace(
+        get_script_run_ctx=lambda: "ctx",
+        add_script_run_ctx=lambda thread, ctx: attached.append((thread.name, ctx)),
+    )
+    monkeypatch.setitem(sys.modules, "streamlit.runtime.scriptrunner", fake)
+    monkeypatch.setattr(llm_handler, "process_chunk", lambda text_chunk, **kwargs: threading.current_thread().name)
+
+    workers = llm_handler.process_chunks_batch(["a", "bb", "ccc"], max_workers=2)
+    assert set(workers) <= {name for name, _ in attached}
+    assert all(ctx == "ctx" for _, ctx in attached)
@@ -1,8 +1,13 @@
 """
 Tests for PDF processing utilities.
 """
+import io
+import fitz
 import pytest
-from utils.pdf_processor import clean_text, recursive_character_text_splitter
+from utils.pdf_processor import (
+    clean_text, recursive_character_text_splitter,
+    extract_text_from_pdf, get_pdf_front_matter, extract_chapters_from_pdf,
+)
 
 def test_clean_text():
     raw = "Hello   World. \n This is \t a test."
@@ -25,3 +30,61 @@ def test_text_splitter_overlap():
     chunks = recursive_character_text_splitter(text, chunk_size=5, overlap=2)
     assert len(chunks) >= 2
     assert "34" in chunks[1]
+
+def _make_pdf(pages):
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return io.BytesIO(data)
+
+def test_extractors_read_every_page():
+    pdf = _make_pdf(["First page", "Second page", "Third page"])
+
+    assert [line for line in extract_text_from_pdf(pdf).splitlines() if line] == ["First page", "Second page", "Third page"]
+    assert "Third" not in get_pdf_front_matter(pdf, page_limit=2)
+
+    chapters = extract_chapters_from_pdf(pdf, ai_extracted_toc=[{"title": "A", "page": 1}, {"title": "B", "page": 3}])
+    assert [c["title"] for c in chapters] == ["A", "B"]
+    assert "Second page" in chapters[0]["text"] and "Third" not in chapters[0]["text"]
+    assert "Third page" in chapters[1]["text"]
+
+def test_nfc_normalizes_only_when_needed():
+    from utils.pdf_processor import _nfc
+    composed = "caf\u00e9"
+    assert _nfc(composed) is composed
+    assert _nfc("cafe\u0301") == composed
+
+def test_parallel_extraction_keeps_page_order(monkeypatch, caplog):
+    import utils.pdf_processor as pdf_processor
+    monkeypatch.setattr(pdf_processor, "PARALLEL_EXTRACT_MIN_PAGES", 2)
+    monkeypatch.setattr(pdf_processor.os, "cpu_count", lambda: 3)
+    pdf = _make_pdf([f"Page {i}" for i in range(7)])
+
+    lines = [line for line in extract_text_from_pdf(pdf).splitlines() if line]
+    assert lines == [f"Page {i}" for i in range(7)]
+    assert "extracting serially" not in caplog.text
+
+def test_text_splitter_python_fallback(monkeypatch):
+    import utils.pdf_processor as pdf_processor
+    monkeypatch.setattr(pdf_processor, "TextSplitter", None)
+    text = "One sentence here. " * 20
+    chunks = recursive_character_text_splitter(text, chunk_size=100, overlap=10)
+    assert all(len(c) <= 100 for c in chunks)
+    assert chunks[0].endswith(". ")
+
+def test_text_splitter_keeps_tiny_tail_within_chunk_size(monkeypatch):
+    import utils.pdf_processor as pdf_processor
+    monkeypatch.setattr(pdf_processor, "TextSplitter", None)
+    text = "x" * 1000 + " tail"
+    chunks = recursive_character_text_splitter(text, chunk_size=1000, overlap=0)
+    assert "".join(chunks) == text
+    assert all(len(c) <= 1000 for c in chunks)
+    chunks = recursive_character_text_splitter("y" * 2000 + " tail", chunk_size=1000, overlap=0)
+    assert [len(c) for c in chunks] == [1000, 1000, 5]
+
+def test_merge_small_spans_stays_within_chunk_size():
+    from utils.pdf_processor import _merge_small_spans
+    assert _merge_small_spans([(0, 900), (900, 930)], 1000) == [(0, 930)]
+    assert _merge_small_spans([(0, 1000), (1000, 1005)], 1000) == [(0, 1000), (1000, 1005)]
@@ -5,6 +5,7 @@ import pytest
 import os
 import sqlite3
 import numpy as np
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 from utils.rag import SQLiteVectorStore
 
@@ -66,3 +67,127 @@ def test_clear(vector_store, monkeypatch):
         cursor = conn.cursor()
         cursor.execute("SELECT count(*) FROM chunks")
         assert cursor.fetchone()[0] == 0
+
+def test_add_chunks_embeds_in_one_batch(vector_store, monkeypatch):
+    calls = []
+    def fake_get_embeddings(texts, google_client=None, zai_client=None):
+        calls.append(list(texts))
+        return [[float(len(t)), 1.0, 0.0] for t in texts]
+    monkeypatch.setattr("utils.rag.get_embeddings", fake_get_embeddings)
+
+    long_a = "a" * 60
+    long_b = "b" * 70
+    vector_store.add_chunks([long_a, "short", long_b], google_client=None,
+                            metadata_list=[{"n": 0}, {"n": 1}, {"n": 2}])
+
+    assert calls == [[long_a, long_b]]
+    assert [c["text"] for c in vector_store.chunks] == [long_a, long_b]
+    assert [c["metadata"]["n"] for c in vector_store.chunks] == [0, 2]
+    assert len(SQLiteVectorStore(db_path=vector_store.db_path)) == 2
+
+def test_search_uses_grown_matrix(vector_store, monkeypatch):
+    vectors = {}
+    def fake_get_embeddings(texts, google_client=None, zai_client=None):
+        return [vectors[t] for t in texts]
+    def fake_get_embedding(text, google_client=None, zai_client=None):
+        return vectors[text]
+    monkeypatch.setattr("utils.rag.get_embeddings", fake_get_embeddings)
+    monkeypatch.setattr("utils.rag.get_embedding", fake_get_embedding)
+
+    texts = [f"chunk {i} " + "x" * 60 for i in range(5)]
+    for i, text in enumerate(texts):
+        vectors[text] = [float(i == j) for j in range(5)]
+        vector_store.add_chunks([text], google_client=None)  # Forces repeated growth
+    vectors["query"] = [0.0, 0.0, 0.0, 2.0, 0.1]
+
+    assert [c["text"] for c in vector_store.search("query", None, k=2)] == [texts[3], texts[4]]
+
+    reloaded = SQLiteVectorStore(db_path=vector_store.db_path)
+    assert reloaded.search("query", None, k=1)[0]["text"] == texts[3]
+
+def test_embeddings_persisted_normalized(vector_store, monkeypatch):
+    monkeypatch.setattr("utils.rag.get_embeddings", lambda texts, **kw: [[3.0, 4.0, 0.0] for _ in texts])
+    vector_store.add_chunks(["n" * 60], google_client=None)
+
+    with sqlite3.connect(vector_store.db_path) as conn:
+        blob = conn.execute("SELECT embedding FROM chunks").fetchone()[0]
+    assert np.allclose(np.frombuffer(blob, dtype=np.float32), [0.6, 0.8, 0.0])
+
+def test_load_copies_rows_into_one_matrix(vector_store):
+    rows = [("legacy " + "x" * 60, None, np.array([3.0, 4.0], dtype=np.float32).tobytes()),
+            ("corrupt " + "x" * 60, None, b"\x00" * 12),
+            ("unit " + "x" * 60, '{"source": "a"}', np.array([0.0, 1.0], dtype=np.float32).tobytes())]
+    with sqlite3.connect(vector_store.db_path) as conn:
+        conn.executemany("INSERT INTO chunks (text, metadata, embedding) VALUES (?, ?, ?)", rows)
+
+    store = SQLiteVectorStore(db_path=vector_store.db_path)
+    assert [c["text"][:4] for c in store.chunks] == ["lega", "unit"]
+    assert store.chunks[1]["metadata"] == {"source": "a"}
+    assert np.allclose(store._matrix[:store._count], [[0.6, 0.8], [0.0, 1.0]])
+
+def test_repeated_chunks_embedded_once(vector_store, monkeypatch):
+    sent = []
+    def embed_content(model, contents):
+        sent.extend(contents)
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=[1.0, float(len(t))]) for t in contents])
+    client = {"primary": SimpleNamespace(models=SimpleNamespace(embed_content=embed_content)), "fallbacks": []}
+
+    header = "Running header repeated on every chapter of the book " * 2
+    body = "Chapter body text that only appears once in the document " * 2
+    vector_store.add_chunks([header, body, header], google_client=client)
+    vector_store.add_chunks([header], google_client=client)
+
+    assert sent == [header, body]
+    # The repeated header is stored once
+    assert [c["text"] for c in vector_store.chunks] == [header, body]
+    assert len(SQLiteVectorStore(db_path=vector_store.db_path)) == 2
+
+    vector_store.clear()
+    vector_store.add_chunks([header], google_client=client)
+    assert len(vector_store) == 1
+
+def test_store_keeps_one_wal_connection(vector_store, monkeypatch):
+    monkeypatch.setattr("utils.rag.get_embeddings", lambda texts, **kw: [[1.0, 0.0] for _ in texts])
+    conn = vector_store._conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA page_size").fetchone()[0] == 8192
+
+    vector_store.add_chunks(["w" * 60], google_client=None)
+    vector_store.clear()
+    assert vector_store._conn is conn
+
+    with vector_store as store:
+        assert store is vector_store
+    assert vector_store._conn is None
+
+def test_matrix_growth_stops_at_store_capacity(vector_store, monkeypatch):
+    monkeypatch.setattr("utils.rag.MAX_VECTOR_STORE_CHUNKS", 6)
+    for _ in range(5):
+        vector_store._append_vectors([np.ones(2, dtype=np.float32)])
+    assert vector_store._count == 5
+    assert vector_store._matrix.shape[0] == 6
+
+def test_search_batch_matches_single_search(vector_store, monkeypatch):
+    vectors = {f"doc {i} " + "x" * 60: [float(i == j) for j in range(4)] for i in range(4)}
+    vectors.update({"q1": [0.1, 0.0, 3.0, 0.0], "q2": [0.0, 1.0, 0.0, 0.2], "bad": [], "zero": [0.0] * 4})
+    monkeypatch.setattr("utils.rag.get_embeddings", lambda texts, **kw: [vectors[t] for t in texts])
+    monkeypatch.setattr("utils.rag.get_embedding", lambda text, **kw: vectors[text])
+    vector_store.add_chunks([t for t in vectors if t.startswith("doc")], google_client=None)
+
+    batch = vector_store.search_batch(["q1", "bad", "q2", "zero"], None, k=2)
+    assert batch[0] == vector_store.search("q1", None, k=2)
+    assert batch[2] == vector_store.search("q2", None, k=2)
+    assert batch[0][0]["text"].startswith("doc 2")
+    assert batch[1] == [] and batch[3] == []
+
+def test_metadata_encoding(vector_store, monkeypatch):
+    monkeypatch.setattr("utils.rag.get_embeddings", lambda texts, **kw: [[1.0, 0.0] for _ in texts])
+    shared = {"source": "book.pdf - Chapter 1"}
+    texts = [f"m{i} " + "x" * 60 for i in range(3)]
+    vector_store.add_chunks(texts, google_client=None, metadata_list=[shared, shared, {}])
+
+    with sqlite3.connect(vector_store.db_path) as conn:
+        stored = [row[0] for row in conn.execute("SELECT metadata FROM chunks ORDER BY id")]
+    assert stored[2] is None
+    reloaded = SQLiteVectorStore(db_path=vector_store.db_path)
+    assert [c["metadata"] for c in reloaded.chunks] == [shared, shared, {}]
@@ -6,15 +6,20 @@ Contains modules for:
 - pdf_processor: PDF text extraction and chunking
 - data_processing: CSV parsing and AnkiConnect integration
 - rag: Simple vector store for document retrieval
+- llm_cache: Exact-match cache for deterministic LLM calls
+- dedup: Near-duplicate detection for generated questions
 """
 
 from utils.llm_handler import (
     configure_gemini,
     configure_openrouter,
     process_chunk,
+    process_chunks_batch,
     get_chat_response,
     get_embedding,
+    get_embeddings,
     generate_chapter_summary,
+    generate_chapter_summaries_parallel,
     generate_full_summary,
     detect_chapters_in_text,
     split_text_by_chapters,
@@ -36,15 +41,19 @@ from utils.data_processing import (
 )
 
 from utils.rag import SQLiteVectorStore
+from utils.dedup import DedupIndex
 
 __all__ = [
     # LLM Handler
     "configure_gemini",
     "configure_openrouter", 
     "process_chunk",
+    "process_chunks_batch",
     "get_chat_response",
     "get_embedding",
+    "get_embeddings",
     "generate_chapter_summary",
+    "generate_chapter_summaries_parallel",
     "generate_full_summary",
     "detect_chapters_in_text",
     "split_text_by_chapters",
@@ -61,4 +70,5 @@ __all__ = [
     "deduplicate_cards",
     # RAG
     "SQLiteVectorStore",
+    "DedupIndex",
 ]
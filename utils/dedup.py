@@ -0,0 +1,128 @@
+"""
+Near-duplicate detection for generated card questions.
+
+Uses MinHash signatures over character shingles with LSH banding, so each
+new question is compared only against the few earlier questions that share
+a band instead of every question generated so far. Candidates are then
+confirmed with an exact Jaccard over word tokens and word pairs, so questions
+that differ in a single word ("type 1" vs "type 2") are kept.
+"""
+
+import re
+import zlib
+import logging
+import threading
+import numpy as np
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+DEDUP_THRESHOLD = 0.85
+DEDUP_WORD_THRESHOLD = 0.9  # exact Jaccard over words and adjacent word pairs a candidate must reach
+DEDUP_NUM_PERM = 64
+DEDUP_BANDS = 16  # 4 rows per band: candidates from ~0.5 similarity, verified against the threshold
+SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+class DedupIndex:
+    """
+    Thread-safe MinHash LSH index of card questions.
+
+    Attributes:
+        threshold: Minimum estimated character-shingle Jaccard similarity for a candidate.
+        word_threshold: Minimum exact word Jaccard similarity for a near-duplicate.
+        num_perm: Number of hash permutations per signature.
+        bands: Number of LSH bands; must divide num_perm.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = DEDUP_NUM_PERM, bands: int = DEDUP_BANDS, word_threshold: float = DEDUP_WORD_THRESHOLD):
+        """Initialize the hash permutations and empty buckets."""
+        if num_perm % bands:
+            raise ValueError("bands must divide num_perm")
+        self.threshold = threshold
+        self.word_threshold = word_threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self._rows = num_perm // bands
+        rng = np.random.default_rng(1)
+        # a * x stays below 2**63 for 32-bit shingle hashes, so uint64 math cannot overflow
+        self._a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._signatures: List[np.ndarray] = []
+        self._words: List[frozenset] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shingles(text: str) -> set:
+        """Character shingles of the lowercased text with punctuation collapsed."""
+        norm = _NON_WORD.sub(" ", text.lower()).strip()
+        if len(norm) <= SHINGLE_SIZE:
+            return {norm}
+        return {norm[i:i + SHINGLE_SIZE] for i in range(len(norm) - SHINGLE_SIZE + 1)}
+
+    @staticmethod
+    def _word_set(text: str) -> frozenset:
+        """Words of the normalized text plus adjacent word pairs, so word order counts."""
+        words = _NON_WORD.sub(" ", text.lower()).split()
+        return frozenset(words + list(zip(words, words[1:])))
+
+    def _signature(self, text: str) -> np.ndarray:
+        """MinHash signature: per permutation, the minimum hash over all shingles."""
+        hashes = np.fromiter((zlib.crc32(s.encode()) for s in self._shingles(text)), dtype=np.uint64)
+        return ((np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME).min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self._rows:(i + 1) * self._rows].tobytes() for i in range(self.bands)]
+
+    def _has_match(self, signature: np.ndarray, band_keys: List[bytes], words: frozenset) -> bool:
+        candidates = set()
+        for bucket, key in zip(self._buckets, band_keys):
+            candidates.update(bucket.get(key, ()))
+        for i in candidates:
+            if np.mean(self._signatures[i] == signature) < self.threshold:
+                continue
+            other = self._words[i]
+            union = len(words | other)
+            if not union or len(words & other) / union >= self.word_threshold:
+                return True
+        return False
+
+    def is_duplicate(self, text: str) -> bool:
+        """Return True if a near-duplicate of text is already indexed."""
+        signature = self._signature(text)
+        with self._lock:
+            return self._has_match(signature, self._band_keys(signature), self._word_set(text))
+
+    def add(self, text: str) -> bool:
+        """Index text unless a near-duplicate exists. Returns True if it was added."""
+        signature = self._signature(text)
+        band_keys = self._band_keys(signature)
+        words = self._word_set(text)
+        with self._lock:
+            if self._has_match(signature, band_keys, words):
+                return False
+            idx = len(self._signatures)
+            self._signatures.append(signature)
+            self._words.append(words)
+            for bucket, key in zip(self._buckets, band_keys):
+                bucket.setdefault(key, []).append(idx)
+            return True
+
+    def filter_tsv(self, tsv: str) -> str:
+        """Drop card rows whose Front is a near-duplicate of an indexed question; index the rest."""
+        kept = []
+        for line in tsv.splitlines():
+            delimiter = "\t" if "\t" in line else ("|" if "|" in line else None)
+            front = line.split(delimiter, 1)[0].strip().strip('"') if delimiter else ""
+            if not front or self.add(front):
+                kept.append(line)
+            else:
+                logger.info(f"Dropped near-duplicate card: {front[:100]}")
+        return "\n".join(kept)
+
+    def __len__(self) -> int:
+        return len(self._signatures)
@@ -0,0 +1,183 @@
+"""
+Exact-match response cache for deterministic LLM calls.
+
+Responses generated at low temperature are effectively deterministic, so
+identical (model, temperature, prompt) requests can be answered from a
+disk cache instead of a new API round-trip. Uses diskcache when installed
+and a bounded in-process dict otherwise. Embeddings are kept in their own
+in-memory LRU in front of the same disk cache.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import functools
+import threading
+import numpy as np
+from collections import OrderedDict
+
+try:
+    import diskcache  # Optional: persists responses across restarts
+except ImportError:
+    diskcache = None
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join("data", ".llm_cache"))
+LLM_CACHE_SIZE_LIMIT = 2**30  # bytes on disk
+LLM_CACHE_TTL = 86400  # seconds
+LLM_MEMORY_CACHE_ENTRIES = 256  # used when diskcache is not installed
+MAX_CACHEABLE_TEMPERATURE = 0.2
+EMBEDDING_MEMORY_ENTRIES = 8192  # a full vector store (5000 chunks) plus queries; ~3 KB each at 768 dims
+EMBEDDING_CACHE_TTL = 30 * 86400  # seconds; embeddings of a model never change
+
+_cache = None
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+_embeddings = OrderedDict()  # key -> float32 bytes, most recently used last
+_embeddings_lock = threading.Lock()
+
+
+def _get_cache():
+    """Opens the cache once: diskcache if installed, else an in-process dict."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if diskcache is not None:
+                try:
+                    _cache = diskcache.Cache(LLM_CACHE_DIR, size_limit=LLM_CACHE_SIZE_LIMIT)
+                except Exception as e:
+                    logger.warning(f"Disk cache unavailable, using in-memory cache: {e}")
+            if _cache is None:
+                _cache = {}
+        return _cache
+
+
+def make_key(**parts) -> str:
+    """Hashes the request parts into a stable cache key."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _count(hits: int = 0, misses: int = 0) -> None:
+    """Adds to the hit/miss counters; cache lookups run in worker threads."""
+    with _stats_lock:
+        _stats["hits"] += hits
+        _stats["misses"] += misses
+
+
+def cached_call(key: str, generate, ttl: int = LLM_CACHE_TTL) -> str:
+    """
+    Returns the cached response text for key, calling generate() on a miss.
+    Only successful, non-empty responses are stored; exceptions propagate uncached.
+    """
+    cache = _get_cache()
+    if isinstance(cache, dict):
+        entry = cache.get(key)
+        cached = entry[1] if entry is not None and entry[0] > time.time() else None
+    else:
+        cached = cache.get(key)
+
+    if cached is not None:
+        _count(hits=1)
+        return cached
+
+    _count(misses=1)
+    text = generate()
+    if text:
+        if isinstance(cache, dict):
+            if len(cache) >= LLM_MEMORY_CACHE_ENTRIES:
+                cache.pop(next(iter(cache)), None)  # Drop the oldest entry
+            cache[key] = (time.time() + ttl, text)
+        else:
+            cache.set(key, text, expire=ttl)
+    return text
+
+
+def llm_cache(ttl: int = LLM_CACHE_TTL):
+    """
+    Caches f(model_name, system_instruction, user_content, client, ...) -> str.
+    The client is not part of the key. Pass use_cache=False to bypass the cache for one call.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(model_name, system_instruction, user_content, client, *args, use_cache: bool = True, **kwargs):
+            if not use_cache:
+                return fn(model_name, system_instruction, user_content, client, *args, **kwargs)
+            key = make_key(f=fn.__name__, m=model_name, s=system_instruction, p=user_content, a=args, kw=kwargs)
+            return cached_call(key, lambda: fn(model_name, system_instruction, user_content, client, *args, **kwargs), ttl=ttl)
+        return wrapper
+    return decorator
+
+
+def _remember_embedding(key: str, blob: bytes) -> None:
+    with _embeddings_lock:
+        _embeddings[key] = blob
+        _embeddings.move_to_end(key)
+        if len(_embeddings) > EMBEDDING_MEMORY_ENTRIES:
+            _embeddings.popitem(last=False)
+
+
+def cached_embeddings(keys: list, embed_missing, ttl: int = EMBEDDING_CACHE_TTL) -> list:
+    """
+    Returns one embedding per key. Keys found in memory or on disk are served from
+    the cache; embed_missing(indices) is called once for the rest and must return one
+    vector per index. Empty (failed) embeddings are not stored.
+    """
+    cache = _get_cache()
+    disk = None if isinstance(cache, dict) else cache
+    results = [None] * len(keys)
+    first_index = {}
+    for i, key in enumerate(keys):
+        with _embeddings_lock:
+            blob = _embeddings.get(key)
+            if blob is not None:
+                _embeddings.move_to_end(key)
+        if blob is None and disk is not None:
+            blob = disk.get(key)
+            if blob is not None:
+                _remember_embedding(key, blob)
+        if blob is not None:
+            results[i] = np.frombuffer(blob, dtype=np.float32).tolist()
+        else:
+            first_index.setdefault(key, i)
+
+    _count(hits=len(keys) - len(first_index), misses=len(first_index))
+    if first_index:
+        missing = list(first_index.values())
+        for i, vector in zip(missing, embed_missing(missing)):
+            results[i] = vector
+            if vector:
+                blob = np.asarray(vector, dtype=np.float32).tobytes()
+                _remember_embedding(keys[i], blob)
+                if disk is not None:
+                    disk.set(keys[i], blob, expire=ttl)
+        # Repeated keys within this call reuse the first computed vector
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = results[first_index[key]]
+    return results
+
+
+def cache_stats() -> dict:
+    """Returns hit/miss counters and the number of cached entries."""
+    cache = _get_cache()
+    try:
+        size = len(cache)
+    except Exception:
+        size = None
+    with _stats_lock:
+        return {"hits": _stats["hits"], "misses": _stats["misses"], "size": size}
+
+
+def clear_cache() -> None:
+    """Removes all cached responses and embeddings and resets the counters."""
+    _get_cache().clear()
+    with _embeddings_lock:
+        _embeddings.clear()
+    with _stats_lock:
+        _stats["hits"] = 0
+        _stats["misses"] = 0
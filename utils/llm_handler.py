@@ -2,35 +2,105 @@ from google import genai
 from google.genai import types
 import os
 import openai
+import httpx
 import time
 import re
 import json
+import hashlib
 import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from utils.pdf_processor import recursive_character_text_splitter
+from utils.llm_cache import llm_cache, cached_call, cached_embeddings, make_key, MAX_CACHEABLE_TEMPERATURE
+
+try:
+    import ahocorasick  # Optional: single-pass multi-pattern search
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson  # Optional: faster JSON decoding of LLM output
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken  # Optional: token-accurate context truncation
+except ImportError:
+    tiktoken = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can keep catching the stdlib error
+_json_loads = orjson.loads if orjson is not None else json.loads
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 
+# HTTP connection pooling: keep idle TLS connections alive across the
+# rate-limit pauses between calls (httpx drops them after 5s by default)
+HTTP_POOL_LIMITS = httpx.Limits(max_keepalive_connections=16, max_connections=32, keepalive_expiry=60.0)
+HTTP_CONNECT_TIMEOUT = 10.0
+HTTP_READ_TIMEOUT = 600.0  # Long card generations can stream for minutes
+GEMINI_CLIENT_CACHE_SIZE = 32  # genai clients (each with its connection pool) kept for reuse
+
+def _gemini_http_options() -> types.HttpOptions:
+    """HTTP options for genai clients with pooled keep-alive connections."""
+    return types.HttpOptions(client_args={"limits": HTTP_POOL_LIMITS})
+
+def _openai_http_client() -> httpx.Client:
+    """Pooled keep-alive HTTP client for OpenAI-compatible providers."""
+    return openai.DefaultHttpxClient(
+        limits=HTTP_POOL_LIMITS,
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+def _key_id(api_key: str):
+    """Hash identifying an API key without keeping the key itself; None if unknown."""
+    return hashlib.sha256(api_key.encode()).hexdigest() if api_key else None
+
+# key hash -> genai client, least recently used first; only the client holds the key
+_CLIENTS: OrderedDict = OrderedDict()
+_CLIENTS_LOCK = threading.Lock()
+
+def _client_for(api_key: str) -> genai.Client:
+    """
+    Returns the genai client for an API key, built on first use and shared afterwards.
+    At most GEMINI_CLIENT_CACHE_SIZE clients are kept; the least recently used is dropped.
+    """
+    key_id = _key_id(api_key)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key_id)
+        if client is not None:
+            _CLIENTS.move_to_end(key_id)
+            return client
+    client = genai.Client(api_key=api_key, http_options=_gemini_http_options())
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.setdefault(key_id, client)
+        _CLIENTS.move_to_end(key_id)
+        while len(_CLIENTS) > GEMINI_CLIENT_CACHE_SIZE:
+            _CLIENTS.popitem(last=False)
+    return client
+
 def configure_gemini(api_key: str, fallback_keys: list = None):
     """
     Configures the Gemini API.
-    Returns: dictionary containing 'primary' and 'fallbacks' clients.
+    Returns: dictionary containing the 'primary' client, its 'primary_key', and 'fallbacks' API keys.
+    Fallback clients are only built via _client_for once the primary key is rate limited.
     """
     clients = {
         "primary": None,
+        "primary_key": None,
         "fallbacks": []
     }
     
     if api_key and api_key.strip():
-        clients["primary"] = genai.Client(api_key=api_key)
+        clients["primary"] = _client_for(api_key)
+        clients["primary_key"] = api_key
         
     if fallback_keys:
-        for key in fallback_keys:
-            if key and key.strip():
-                try:
-                    clients["fallbacks"].append(genai.Client(api_key=key))
-                except Exception as e:
-                    logger.warning(f"Failed to configure fallback key: {e}")
+        clients["fallbacks"] = [key.strip() for key in fallback_keys if key and key.strip()]
     return clients
 
 def configure_openrouter(api_key: str):
@@ -42,6 +112,7 @@ def configure_openrouter(api_key: str):
         return openai.OpenAI(
             base_url=os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1"),
             api_key=api_key,
+            http_client=_openai_http_client(),
         )
     return None
 
@@ -54,6 +125,7 @@ def configure_zai(api_key: str):
         return openai.OpenAI(
             base_url=os.getenv("ZAI_API_URL", "https://api.z.ai/api/coding/paas/v4"),
             api_key=api_key,
+            http_client=_openai_http_client(),
         )
     return None
 
@@ -62,6 +134,10 @@ RATE_LIMIT_GEMMA = 2.0  # 30 RPM
 RATE_LIMIT_FLASH_LITE = 6.0  # 10 RPM
 RATE_LIMIT_FREE = 3.0  # 20 RPM
 RATE_LIMIT_DEFAULT = 1.0
+# Calls allowed back-to-back after an idle period. Kept at 1 so any 60s window stays within the RPM above.
+RATE_LIMIT_BURST = 1
+KEY_COOLDOWN_SECONDS = 30.0  # A Gemini key that returned 429 is tried after the others for this long
+MAX_RETRY_BACKOFF = 10.0  # Cap on the pause before the next model after a transient failure
 
 # Model fallback lists
 GOOGLE_FALLBACK_MODELS = ["gemini-2.5-flash-lite", "gemini-2.5-flash", "gemini-3-flash", "gemma-3-27b-it"]
@@ -76,35 +152,110 @@ ZAI_FALLBACK_MODELS = [
     "GLM-4.5-air"
 ]
 
-# Context limits
-CONTEXT_LIMIT_DEFAULT = 100000
-CONTEXT_LIMIT_XIAOMI = 200000
+_FALLBACK_MODELS = {
+    "google": tuple(GOOGLE_FALLBACK_MODELS),
+    "openrouter": tuple(OPENROUTER_FALLBACK_MODELS),
+    "zai": tuple(ZAI_FALLBACK_MODELS),
+}
+
+@lru_cache(maxsize=128)
+def _model_chain(model_name: str, provider: str) -> tuple:
+    """The requested model followed by the provider's other fallback models."""
+    return (model_name,) + tuple(m for m in _FALLBACK_MODELS[provider] if m != model_name)
+
+# Context limits (tokens)
+CONTEXT_LIMIT_DEFAULT = 25000
+CONTEXT_LIMIT_XIAOMI = 50000
+CHARS_PER_TOKEN = 4  # Rough English estimate, used when tiktoken is unavailable
 MAX_SAMPLE_TEXT = 1000000
 MAX_TOC_TEXT = 30000
 MAX_SUMMARY_TEXT = 30000
 MAX_VECTOR_STORE_CHUNKS = 5000
 MIN_CHUNK_LENGTH = 50
 
-def rate_limit_delay(model_name: str) -> None:
-    """Enforces rate limits based on model type."""
-    if "gemma" in model_name:
-        delay = RATE_LIMIT_GEMMA
-    elif "flash-lite" in model_name:
-        delay = RATE_LIMIT_FLASH_LITE
-    elif "free" in model_name:
-        delay = RATE_LIMIT_FREE
-    else:
-        delay = RATE_LIMIT_DEFAULT
-    time.sleep(delay)
-
-from tenacity import (
-    retry, 
-    stop_after_attempt, 
-    wait_exponential, 
-    retry_if_exception_type,
-    before_sleep_log
+TARGET_CHUNK_TOKENS = 8192  # Larger chunks are split before card generation
+
+_JSON_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+@lru_cache(maxsize=1)
+def _get_token_encoding():
+    """Loads the tiktoken encoding once. Returns None if tiktoken is unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The encoding file is downloaded on first use and may be unreachable
+        logger.warning(f"Token encoding unavailable, falling back to character limits: {e}")
+        return None
+
+def _token_len(text: str) -> int:
+    """Token count of text; a character-based estimate when tiktoken is unavailable."""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+@lru_cache(maxsize=8)
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    """Truncates text to max_tokens. Cached so multi-turn chats don't re-tokenize the same context."""
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    # No text of this length can exceed the budget (a token spans at least one char)
+    if len(text) <= max_tokens:
+        return text
+    token_ids = encoding.encode(text, disallowed_special=())
+    if len(token_ids) <= max_tokens:
+        return text
+    return encoding.decode(token_ids[:max_tokens])
+
+# (model name substring, delay) checked in order; first match wins
+_DELAY_RULES = (
+    ("gemma", RATE_LIMIT_GEMMA),
+    ("flash-lite", RATE_LIMIT_FLASH_LITE),
+    ("free", RATE_LIMIT_FREE),
 )
 
+@lru_cache(maxsize=128)
+def _delay_for(model_name: str) -> float:
+    """Resolves the per-call delay for a model name once."""
+    return next((delay for key, delay in _DELAY_RULES if key in model_name), RATE_LIMIT_DEFAULT)
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() returns immediately while tokens are
+    available and otherwise sleeps only as long as needed for the next one.
+    """
+    def __init__(self, rate_per_sec: float, capacity: float = RATE_LIMIT_BURST):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token even if it isn't there yet; later callers queue behind this one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+_LIMITERS: dict[str, TokenBucket] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+def rate_limit_delay(model_name: str) -> None:
+    """Enforces rate limits based on model type, sleeping only when the model's bucket is empty."""
+    bucket = _LIMITERS.get(model_name)
+    if bucket is None:
+        with _LIMITERS_LOCK:
+            bucket = _LIMITERS.setdefault(model_name, TokenBucket(1.0 / _delay_for(model_name)))
+    bucket.acquire()
+
 class RateLimitError(Exception):
     """Custom exception for rate limit errors that should be shown to users."""
     def __init__(self, message: str, provider: str = None):
@@ -122,26 +273,60 @@ def signal_rate_limit(message: str):
     except (ImportError, AttributeError, RuntimeError):
         pass  # Not in Streamlit context
 
+def _session_thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    """
+    ThreadPoolExecutor whose workers run in the calling Streamlit script's context, so
+    signal_rate_limit from a worker thread reaches the user's st.session_state.
+    Outside Streamlit this is a plain pool.
+    """
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except ImportError:
+        ctx = None
+    if ctx is None:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
 def _retry_on_api_error(exception):
-    """Return True if exception is a 429 or 503 error."""
-    msg = str(exception).lower()
-    is_rate_limit = "429" in msg or "resource_exhausted" in msg or "503" in msg
+    """Return True if exception is a 429, 503 or 504 error or a request timeout."""
+    if isinstance(exception, (TimeoutError, httpx.TimeoutException, openai.APITimeoutError)):
+        return True
+    # genai errors carry the HTTP status as .code, OpenAI errors as .status_code
+    code = getattr(exception, "status_code", getattr(exception, "code", None))
+    if isinstance(code, int):
+        if code == 504:
+            return True
+        is_rate_limit = code in (429, 503)
+    else:
+        msg = str(exception).lower()
+        is_rate_limit = "429" in msg or "resource_exhausted" in msg or "503" in msg
     if is_rate_limit:
         signal_rate_limit(f"API rate limit hit: {str(exception)[:100]}")
     return is_rate_limit
 
-@retry(
-    retry=retry_if_exception_type(Exception),
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    before_sleep=before_sleep_log(logger, logging.WARNING)
-)
+# (API key hash, model) -> monotonic time until which that key is tried last
+_KEY_COOLDOWNS: dict = {}
+
+def _in_cooldown(api_key: str, model: str) -> bool:
+    """Return True if api_key was rate limited on model within KEY_COOLDOWN_SECONDS."""
+    key_id = _key_id(api_key)
+    return key_id is not None and _KEY_COOLDOWNS.get((key_id, model), 0.0) > time.monotonic()
+
+def _start_cooldown(api_key: str, model: str) -> None:
+    key_id = _key_id(api_key)
+    if key_id is not None:
+        _KEY_COOLDOWNS[(key_id, model)] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
 def _generate_with_retry(model_name: str, contents, config, client_config: dict, fallback_to_flash_lite: bool = True):
     """
     Centralized generation with Key Rotation (Primary -> Fallbacks) and Model Fallback.
+    Each model/key combination is tried at most once per call. After a model fails on
+    429/503/timeout errors, the next model waits with exponential backoff.
     """
     primary_client = client_config.get("primary")
-    fallback_clients = client_config.get("fallbacks", [])
+    primary_key = client_config.get("primary_key")
+    fallback_keys = client_config.get("fallbacks", [])
     
     if not primary_client:
          raise ValueError("Google API Key not configured.")
@@ -149,11 +334,7 @@ def _generate_with_retry(model_name: str, contents, config, client_config: dict,
     rate_limit_delay(model_name)
     
     # Ensure current model is tried first, then the others
-    models_to_try = [model_name]
-    if fallback_to_flash_lite:
-        for m in GOOGLE_FALLBACK_MODELS:
-            if m not in models_to_try:
-                models_to_try.append(m)
+    models_to_try = _model_chain(model_name, "google") if fallback_to_flash_lite else (model_name,)
 
     # Helper to attempt generation on a specific client
     def attempt(client, model):
@@ -164,38 +345,71 @@ def _generate_with_retry(model_name: str, contents, config, client_config: dict,
         )
         
     errors = []
+    backoffs = 0
     
     for current_model in models_to_try:
-        # Try Primary Key
-        try:
-            return attempt(primary_client, current_model)
-        except Exception as e:
-            errors.append(f"Model {current_model} (Primary) Error: {e}")
-            
-            # Key Rotation for fallback clients
-            if _retry_on_api_error(e):
-                for idx, client in enumerate(fallback_clients):
-                    try:
-                        time.sleep(1) 
-                        return attempt(client, current_model)
-                    except Exception as e2:
-                        errors.append(f"Model {current_model} (Fallback {idx+1}) Error: {e2}")
-                        continue
+        retryable = False
+        # Primary first, then fallback keys; keys rate limited on this model recently go last
+        candidates = sorted([None] + list(fallback_keys), key=lambda k: _in_cooldown(k or primary_key, current_model))
+        for n, key in enumerate(candidates):
+            label = "Primary" if key is None else f"Fallback {fallback_keys.index(key) + 1}"
+            try:
+                if n:
+                    time.sleep(1)
+                return attempt(primary_client if key is None else _client_for(key), current_model)
+            except Exception as e:
+                errors.append(f"Model {current_model} ({label}) Error: {e}")
+                # Key rotation only helps with rate limits; other errors move on to the next model
+                if _retry_on_api_error(e):
+                    retryable = True
+                    _start_cooldown(key or primary_key, current_model)
+                elif n == 0:
+                    break
+        if retryable and current_model != models_to_try[-1]:
+            time.sleep(min(2 * 2 ** backoffs, MAX_RETRY_BACKOFF))
+            backoffs += 1
             
-    # If we get here, trigger Tenacity retry by raising exception
+    logger.warning(f"All Gemini attempts failed for {model_name}")
     raise Exception(f"All attempts failed. Errors: {'; '.join(errors)}")
 
 
-def _generate_with_openrouter(model_name: str, system_instruction: str, user_content: str, client):
+def _generate_text_with_retry(model_name: str, prompt: str, config, client_config: dict, fallback_to_flash_lite: bool = True, use_cache: bool = True) -> str:
+    """
+    Returns response text from _generate_with_retry, served from the exact-match
+    cache when the request is a plain prompt at low temperature.
+    """
+    generate = lambda: _generate_with_retry(model_name, prompt, config, client_config, fallback_to_flash_lite=fallback_to_flash_lite).text
+    temperature = config.temperature if config.temperature is not None else 1.0
+    if not use_cache or not isinstance(prompt, str) or temperature > MAX_CACHEABLE_TEMPERATURE:
+        return generate()
+
+    key = make_key(
+        f="_generate_with_retry", m=model_name, t=temperature, p=prompt,
+        s=config.system_instruction, mime=config.response_mime_type,
+        max_tokens=config.max_output_tokens, fallback=fallback_to_flash_lite
+    )
+    return cached_call(key, generate)
+
+
+def _chat_messages(system_instruction: str, user_content: str, extra_instruction: str = "") -> list:
+    """
+    OpenAI-style messages. extra_instruction goes in its own system message after the
+    static one, so the unchanged first message stays a cacheable prompt prefix.
+    """
+    messages = [{"role": "system", "content": system_instruction}]
+    if extra_instruction:
+        messages.append({"role": "system", "content": extra_instruction})
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+@llm_cache()
+def _generate_with_openrouter(model_name: str, system_instruction: str, user_content: str, client, extra_instruction: str = ""):
     """Generates content using OpenRouter with 429 fallback to other free models."""
     if not client:
         raise ValueError("OpenRouter API Key not configured.")
 
     # Try the requested model first, then fallbacks
-    models_to_try = [model_name]
-    for m in OPENROUTER_FALLBACK_MODELS:
-        if m not in models_to_try:
-            models_to_try.append(m)
+    models_to_try = _model_chain(model_name, "openrouter")
 
     errors = []
     for current_model in models_to_try:
@@ -205,10 +419,7 @@ def _generate_with_openrouter(model_name: str, system_instruction: str, user_con
                 time.sleep(1) # Extra pause between different model attempts
             response = client.chat.completions.create(
                 model=current_model,
-                messages=[
-                    {"role": "system", "content": system_instruction},
-                    {"role": "user", "content": user_content}
-                ],
+                messages=_chat_messages(system_instruction, user_content, extra_instruction),
                 temperature=0.2,
                 max_tokens=16000
             )
@@ -228,16 +439,14 @@ def _generate_with_openrouter(model_name: str, system_instruction: str, user_con
     signal_rate_limit("All OpenRouter models exhausted due to rate limits")
     raise Exception(f"All OpenRouter models failed. Errors: {'; '.join(errors[-3:])}")
 
-def _generate_with_zai(model_name: str, system_instruction: str, user_content: str, client):
+@llm_cache()
+def _generate_with_zai(model_name: str, system_instruction: str, user_content: str, client, extra_instruction: str = ""):
     """Generates content using Z.AI with fallback."""
     if not client:
         raise ValueError("Z.AI API Key not configured.")
 
     # Try the requested model first, then fallbacks
-    models_to_try = [model_name]
-    for m in ZAI_FALLBACK_MODELS:
-        if m not in models_to_try:
-            models_to_try.append(m)
+    models_to_try = _model_chain(model_name, "zai")
 
     errors = []
     for current_model in models_to_try:
@@ -247,10 +456,7 @@ def _generate_with_zai(model_name: str, system_instruction: str, user_content: s
                 time.sleep(1)
             response = client.chat.completions.create(
                 model=current_model,
-                messages=[
-                    {"role": "system", "content": system_instruction},
-                    {"role": "user", "content": user_content}
-                ],
+                messages=_chat_messages(system_instruction, user_content, extra_instruction),
                 temperature=0.2,
                 max_tokens=16000
             )
@@ -267,34 +473,74 @@ def _generate_with_zai(model_name: str, system_instruction: str, user_content: s
     signal_rate_limit("All Z.AI models exhausted due to rate limits")
     raise Exception(f"All Z.AI models failed. Errors: {'; '.join(errors)}")
 
-def get_chat_response(messages: list, context: str, provider: str, model_name: str, google_client=None, openrouter_client=None, zai_client=None, direct_chat: bool = False) -> str:
+# Chat history conversion cache: id(message) -> (content text, role, types.Content)
+_ROLE_MAP = {"user": "user", "assistant": "model"}
+_HIST_CACHE: dict = {}
+_HIST_CACHE_MAX = 4096
+
+def _to_content(message: dict):
+    """Converts a chat message to Gemini Content, reusing the conversion from earlier turns."""
+    text = message["content"]
+    role = message["role"]
+    cached = _HIST_CACHE.get(id(message))
+    # ids are reused after a message is freed, so confirm it is still the same message
+    if cached is not None and cached[0] is text and cached[1] == role:
+        return cached[2]
+
+    content = types.Content(role=_ROLE_MAP.get(role, "model"), parts=[types.Part.from_text(text=text)])
+    if len(_HIST_CACHE) >= _HIST_CACHE_MAX:
+        _HIST_CACHE.clear()
+    _HIST_CACHE[id(message)] = (text, role, content)
+    return content
+
+def _gemini_history(messages: list, history_state: dict = None) -> list:
+    """
+    Converts chat messages to Gemini Content. With a history_state from the previous turn
+    of the same conversation, only the messages appended since then are converted.
+    """
+    if history_state is None:
+        return [_to_content(m) for m in messages]
+    hist = history_state.get("gemini_hist")
+    # A replaced (cleared) or shortened message list starts a new conversation
+    if hist is None or history_state.get("source") is not messages or len(hist) > len(messages):
+        hist = []
+    hist.extend(_to_content(m) for m in messages[len(hist):])
+    history_state["source"] = messages
+    history_state["gemini_hist"] = hist
+    return hist
+
+@lru_cache(maxsize=8)
+def _rag_system_prompt(context: str, context_limit: int) -> str:
+    """Builds the document-chat system prompt once per (context, limit) across chat turns."""
+    return f"""You are a helpful Medical Assistant AI. 
+        Answer questions based strictly on the provided medical context.
+        
+        Context:
+        {_truncate_tokens(context, context_limit)} 
+        
+        (Context truncated to {context_limit} tokens for safety)
+        """
+
+def get_chat_response(messages: list, context: str, provider: str, model_name: str, google_client=None, openrouter_client=None, zai_client=None, direct_chat: bool = False, history_state: dict = None) -> str:
     """
     Handles chat interaction.
     If direct_chat=True, it chats with the model directly without document context.
     messages: list of {"role": "user"|"assistant", "content": "..."}
+    history_state: optional dict kept by the caller across turns of one conversation, so
+        only newly appended messages are converted to Gemini format.
     """
     if direct_chat:
         system_prompt = "You are a helpful and intelligent AI assistant. Answer the user's questions clearly and accurately."
     else:
         context_limit = CONTEXT_LIMIT_XIAOMI if "xiaomi" in model_name.lower() else CONTEXT_LIMIT_DEFAULT
-        system_prompt = f"""You are a helpful Medical Assistant AI. 
-        Answer questions based strictly on the provided medical context.
-        
-        Context:
-        {context[:context_limit]} 
-        
-        (Context truncated to {context_limit} chars for safety)
-        """
+        system_prompt = _rag_system_prompt(context, context_limit)
     
     if provider == "google":
         client_config = google_client
         if not client_config or not client_config.get("primary"): return "Error: Google Client not configured."
         
         # Convert messages to Gemini format (user/model)
-        gemini_hist = []
-        for m in messages:
-            role = "user" if m["role"] == "user" else "model"
-            gemini_hist.append(types.Content(role=role, parts=[types.Part.from_text(text=m["content"])]))
+        gemini_hist = _gemini_history(messages, history_state)
             
         config = types.GenerateContentConfig(
             system_instruction=system_prompt,
@@ -358,35 +604,123 @@ def get_chat_response(messages: list, context: str, provider: str, model_name: s
     
     return "Error: Invalid Provider"
 
-def get_embedding(text: str, provider: str = "google", model_name: str = "text-embedding-004", google_client=None, zai_client=None) -> list:
-    """Generates an embedding vector for the given text."""
-    try:
-        if provider == "google":
-            client_config = google_client
-            if not client_config or not client_config.get("primary"): return []
-            primary_client = client_config["primary"]
-            
+EMBEDDING_BATCH_SIZE = 100  # Gemini batchEmbedContents request cap
+EMBEDDING_CONCURRENCY = 4  # Batch requests in flight at once for large inputs
+
+def get_embeddings(texts: list[str], provider: str = "google", model_name: str = "text-embedding-004", google_client=None, zai_client=None, batch_size: int = EMBEDDING_BATCH_SIZE) -> list[list]:
+    """
+    Generates embedding vectors for many texts, one API request per batch, with
+    several batches in flight at once. Texts embedded before with the same model
+    are served from the embedding cache.
+    Returns one vector per input text; texts that could not be embedded get [].
+    """
+    if provider != "google":
+        # OpenRouter/Z.AI embedding support is variable, not used for now
+        return [[] for _ in texts]
+
+    client_config = google_client
+    if not client_config or not client_config.get("primary"):
+        return [[] for _ in texts]
+    primary_client = client_config["primary"]
+
+    def embed_batch(batch):
+        try:
             result = primary_client.models.embed_content(
                 model=model_name,
-                contents=text
+                contents=batch
             )
-            return result.embeddings[0].values
-        elif provider == "openrouter":
-            # OpenRouter might support embeddings, but it's variable.
-            return [] 
-        elif provider == "zai":
-             # Z.AI embedding support? Assuming no or not specified, return empty for now
-            return [] 
-    except Exception as e:
-        print(f"Embedding check failed: {e}")
-        return []
+            vectors = [emb.values for emb in result.embeddings[:len(batch)]]
+            return vectors + [[]] * (len(batch) - len(vectors))
+        except Exception as e:
+            logger.warning(f"Embedding batch failed: {e}")
+            return [[]] * len(batch)
+
+    def embed_missing(indices):
+        batches = [[texts[i] for i in indices[start:start + batch_size]] for start in range(0, len(indices), batch_size)]
+        if len(batches) == 1:
+            return embed_batch(batches[0])
+        # Batches are independent requests; keep a few in flight at once
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_CONCURRENCY, len(batches))) as executor:
+            return [vector for vectors in executor.map(embed_batch, batches) for vector in vectors]
+
+    keys = [make_key(f="embed_content", p=provider, m=model_name, t=text) for text in texts]
+    return cached_embeddings(keys, embed_missing)
+
+def get_embedding(text: str, provider: str = "google", model_name: str = "text-embedding-004", google_client=None, zai_client=None) -> list:
+    """Generates an embedding vector for the given text."""
+    return get_embeddings([text], provider=provider, model_name=model_name, google_client=google_client, zai_client=zai_client)[0]
+
+
+def _is_card_row(line: str) -> bool:
+    """A card row contains a double quote and a TAB/pipe delimiter (in either order)."""
+    return '"' in line and ('\t' in line or '|' in line)
 
+def _strip_fence(text: str) -> str:
+    """Returns the body of the first ``` fence (dropping a csv/tsv tag), or text if unfenced."""
+    start = text.find("```")
+    if start == -1:
+        return text
+    end = text.find("```", start + 3)
+    if end == -1:
+        return text
+    body = text[start + 3:end]
+    if body[:3].lower() in ("csv", "tsv"):
+        body = body[3:]
+    return body.strip()
 
-def process_chunk(text_chunk: str, google_client=None, openrouter_client=None, zai_client=None, provider: str = "google", model_name: str = "gemini-3-flash", card_length: str = "Medium (Standard)", card_density: str = "Normal", enable_highlighting: bool = False, custom_prompt: str = "", formatting_mode: str = "Markdown/HTML", existing_topics: list[str] = None) -> str:
+def _clean_tsv(text_resp: str) -> str:
     """
-    Sends a text chunk to the selected Provider/Model and retrieves Anki CSV cards.
-    formatting_mode: "Plain Text", "Markdown/HTML", or "LaTeX/KaTeX"
-    existing_topics: list of titles/questions already generated to avoid duplicates.
+    Strips code fences and non-card lines from a model's TSV reply.
+    Pure module-level function so it can be handed to an executor.
+    """
+    # Remove markdown code blocks if present
+    text = _strip_fence(text_resp.strip())
+    
+    # Additional cleanup: Remove lines that don't look like CSV/TSV data
+    clean_lines = [line for line in map(str.strip, text.splitlines()) if _is_card_row(line)]
+    
+    if clean_lines:
+        text = "\n".join(clean_lines)
+        
+    return text
+
+# formatting_mode -> (formatting rule, highlight rule when highlighting is enabled)
+_FORMATTING_RULES = {
+    "Basic + MathJax": (
+        "Rule: Use ONLY HTML tags for formatting. For bold use <b>text</b>, for italics use <i>text</i>, for superscript use <sup>text</sup>, for subscript use <sub>text</sub>. Do NOT use Markdown (no ** or *). Do NOT use LaTeX delimiters like $ or \\\\(. Keep it simple HTML that works in default Anki Basic cards.",
+        "Rule: Use <b>text</b> to highlight the most high-yield keywords/associations in the Answer.",
+    ),
+    "Legacy LaTeX": (
+        "Rule: Use Anki's legacy LaTeX format with [latex]...[/latex] tags for math. Example: [latex]H_2O[/latex], [latex]\\\\frac{1}{2}[/latex]. Use plain text or simple HTML otherwise.",
+        "Rule: Use <b>text</b> to highlight the most high-yield keywords in the Answer.",
+    ),
+    "Markdown/HTML": (
+        "Rule: Use Markdown for text formatting (bold with **text**, italics with *text*). For math/chemistry, use HTML tags (e.g., <sup>, <sub>). Do NOT use LaTeX.",
+        "Rule: Use bold (**text**) to highlight the most high-yield keywords/associations in the Answer.",
+    ),
+}
+
+def _card_prefix(formatting_instruction: str) -> str:
+    """Static part of the card-generation instruction: role and rules 1-5."""
+    return f"""You are a world-class Anki flashcard creator that helps students create flashcards that help them remember facts, concepts, and ideas from videos. You will be given a video or document or snippet.
+    
+    Identify key high-level concepts and ideas presented, including relevant equations. If the content is math or physics-heavy, focus on concepts. If the content isn't heavy on concepts, focus on facts. Use your own knowledge to flesh out any additional details (e.g., relevant facts, dates, and equations) to ensure the flashcards are self-contained.
+
+    Rules:
+    1. Formatting: {formatting_instruction}
+    2. TSV Structure: "Front"[TAB]"Back". Use a TAB character as the delimiter (not pipe, not comma). Enclose EVERY field in double quotes. If a field contains a double quote, escape it by doubling it (" -> "").
+    3. Completeness: EVERY card MUST have a Question (Front) AND an Answer (Back). Do not generate headers.
+    4. Strictness: Output ONLY the TSV content. No code fences. One card per line.
+    5. NO DUPLICATES: Do NOT generate duplicate or near-duplicate questions. Each card must test a UNIQUE concept. If you've already created a card about a topic, do NOT rephrase the same question.
+    """
+
+# Built once so every call with the same mode sends a byte-identical prefix the provider can cache
+_PREFIX_BY_MODE = {mode: _card_prefix(rules[0]) for mode, rules in _FORMATTING_RULES.items()}
+
+def _build_card_instruction(card_length: str, card_density: str, enable_highlighting: bool, custom_prompt: str, formatting_mode: str, existing_topics: list[str] = None) -> tuple[str, str]:
+    """
+    Builds the card-generation instruction for the given settings.
+    Returns: (static prefix shared by all calls with this formatting mode, per-call preferences).
     """
     # Determine Rules based on settings
     length_instruction = ""
@@ -406,21 +740,10 @@ def process_chunk(text_chunk: str, google_client=None, openrouter_client=None, z
         # Normal density - balanced card generation
         density_instruction = "Rule: DENSITY = NORMAL. Generate cards for main ideas and key supporting details. Avoid trivial facts. Target 5-15 cards per chunk."
 
-    highlight_instruction = ""
-    
-    # Formatting Mode Instructions
-    if formatting_mode == "Basic + MathJax":
-        formatting_instruction = "Rule: Use ONLY HTML tags for formatting. For bold use <b>text</b>, for italics use <i>text</i>, for superscript use <sup>text</sup>, for subscript use <sub>text</sub>. Do NOT use Markdown (no ** or *). Do NOT use LaTeX delimiters like $ or \\\\(. Keep it simple HTML that works in default Anki Basic cards."
-        if enable_highlighting:
-            highlight_instruction = "Rule: Use <b>text</b> to highlight the most high-yield keywords/associations in the Answer."
-    elif formatting_mode == "Legacy LaTeX":
-        formatting_instruction = "Rule: Use Anki's legacy LaTeX format with [latex]...[/latex] tags for math. Example: [latex]H_2O[/latex], [latex]\\\\frac{1}{2}[/latex]. Use plain text or simple HTML otherwise."
-        if enable_highlighting:
-            highlight_instruction = "Rule: Use <b>text</b> to highlight the most high-yield keywords in the Answer."
-    else:  # Default: Markdown
-        formatting_instruction = "Rule: Use Markdown for text formatting (bold with **text**, italics with *text*). For math/chemistry, use HTML tags (e.g., <sup>, <sub>). Do NOT use LaTeX."
-        if enable_highlighting:
-            highlight_instruction = "Rule: Use bold (**text**) to highlight the most high-yield keywords/associations in the Answer."
+    # Formatting Mode Instructions (default: Markdown)
+    if formatting_mode not in _FORMATTING_RULES:
+        formatting_mode = "Markdown/HTML"
+    highlight_instruction = _FORMATTING_RULES[formatting_mode][1] if enable_highlighting else ""
 
     custom_instruction_str = ""
     if custom_prompt:
@@ -433,25 +756,45 @@ def process_chunk(text_chunk: str, google_client=None, openrouter_client=None, z
         topics_str = "; ".join(existing_topics[-10:]) 
         anti_dupe_instruction = f"9. ANTI-DUPLICATE: The following concepts have ALREADY been generated. Do NOT create cards for them: [{topics_str}]"
     
-    system_instruction = f"""You are a world-class Anki flashcard creator that helps students create flashcards that help them remember facts, concepts, and ideas from videos. You will be given a video or document or snippet.
-    
-    Identify key high-level concepts and ideas presented, including relevant equations. If the content is math or physics-heavy, focus on concepts. If the content isn't heavy on concepts, focus on facts. Use your own knowledge to flesh out any additional details (e.g., relevant facts, dates, and equations) to ensure the flashcards are self-contained.
-
-    Rules:
-    1. Formatting: {formatting_instruction}
-    2. TSV Structure: "Front"[TAB]"Back". Use a TAB character as the delimiter (not pipe, not comma). Enclose EVERY field in double quotes. If a field contains a double quote, escape it by doubling it (" -> "").
-    3. Completeness: EVERY card MUST have a Question (Front) AND an Answer (Back). Do not generate headers.
-    4. Strictness: Output ONLY the TSV content. No code fences. One card per line.
-    5. NO DUPLICATES: Do NOT generate duplicate or near-duplicate questions. Each card must test a UNIQUE concept. If you've already created a card about a topic, do NOT rephrase the same question.
-    
-    Custom Preferences:
+    preferences = f"""Custom Preferences:
     6. {length_instruction}
     7. {density_instruction}
     8. {highlight_instruction}
     {custom_instruction_str}
     {anti_dupe_instruction}
     """
+    return _PREFIX_BY_MODE[formatting_mode], preferences
+
+def process_chunk(text_chunk: str, google_client=None, openrouter_client=None, zai_client=None, provider: str = "google", model_name: str = "gemini-3-flash", card_length: str = "Medium (Standard)", card_density: str = "Normal", enable_highlighting: bool = False, custom_prompt: str = "", formatting_mode: str = "Markdown/HTML", existing_topics: list[str] = None, dedup_index=None, use_cache: bool = False) -> str:
+    """
+    Sends a text chunk to the selected Provider/Model and retrieves Anki CSV cards.
+    formatting_mode: "Plain Text", "Markdown/HTML", or "LaTeX/KaTeX"
+    existing_topics: list of titles/questions already generated to avoid duplicates.
+    dedup_index: optional DedupIndex; near-duplicate questions are dropped locally after
+        generation, so existing_topics is not sent to the model.
+    use_cache: reuse an identical earlier response from the exact-match LLM cache. Off by
+        default so regenerating a chunk produces new cards.
+    """
+    # Oversized chunks are generated in token-budget pieces and their cards concatenated
+    if len(text_chunk) > TARGET_CHUNK_TOKENS:
+        n_tokens = _token_len(text_chunk)
+        if n_tokens > TARGET_CHUNK_TOKENS:
+            part_chars = max(1, len(text_chunk) * TARGET_CHUNK_TOKENS // n_tokens)
+            parts = recursive_character_text_splitter(text_chunk, chunk_size=part_chars, overlap=0)
+            if len(parts) > 1:
+                results = [
+                    process_chunk(part, google_client, openrouter_client, zai_client, provider, model_name, card_length, card_density, enable_highlighting, custom_prompt, formatting_mode, existing_topics, dedup_index, use_cache)
+                    for part in parts
+                ]
+                cards = [r for r in results if r and not r.startswith("Error")]
+                return "\n".join(cards) if cards else results[0]
+            # A split that makes no progress would recurse forever; send the budget's worth instead
+            text_chunk = _truncate_tokens(text_chunk, TARGET_CHUNK_TOKENS)
 
+    if dedup_index is not None:
+        existing_topics = None
+    use_cache = use_cache and not existing_topics
+    system_instruction, preferences = _build_card_instruction(card_length, card_density, enable_highlighting, custom_prompt, formatting_mode, existing_topics)
 
     try:
         if provider == "google":
@@ -460,43 +803,40 @@ def process_chunk(text_chunk: str, google_client=None, openrouter_client=None, z
                 temperature=0.2,
                 max_output_tokens=65536,
             )
-            response = _generate_with_retry(model_name, text_chunk, config, google_client, fallback_to_flash_lite=True)
-            text_resp = response.text
+            # Per-call preferences lead the user turn so the system instruction stays a stable prefix
+            text_resp = _generate_text_with_retry(model_name, f"{preferences}\n{text_chunk}", config, google_client, fallback_to_flash_lite=True, use_cache=use_cache)
         elif provider == "openrouter":
-            text_resp = _generate_with_openrouter(model_name, system_instruction, text_chunk, openrouter_client)
+            text_resp = _generate_with_openrouter(model_name, system_instruction, text_chunk, openrouter_client, extra_instruction=preferences, use_cache=use_cache)
         elif provider == "zai":
-             text_resp = _generate_with_zai(model_name, system_instruction, text_chunk, zai_client)
+             text_resp = _generate_with_zai(model_name, system_instruction, text_chunk, zai_client, extra_instruction=preferences, use_cache=use_cache)
         else:
              return "Error: Invalid Provider Selected"
         
-        # Clean up response if it contains markdown code blocks
-        text = text_resp.strip()
-        
-        # Remove markdown code blocks if present
-        if "```" in text:
-            match = re.search(r"```(?:csv|tsv)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
-            if match:
-                text = match.group(1).strip()
-        
-        # Additional cleanup: Remove lines that don't look like CSV/TSV data
-        lines = text.splitlines()
-        clean_lines = []
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            # Basic heuristic: accept lines with quotes and delimiter
-            if '"' in line and ("\t" in line or "|" in line):
-                 clean_lines.append(line)
-        
-        if clean_lines:
-            text = "\n".join(clean_lines)
-            
+        text = _clean_tsv(text_resp)
+        if dedup_index is not None:
+            text = dedup_index.filter_tsv(text)
         return text
     except Exception as e:
         # Sanitize error message to avoid information leakage
         logger.error(f"Error processing chunk: {e}")
         return "Error processing chunk. Please try again or contact support if the issue persists."
 
+def process_chunks_batch(chunks: list[str], max_workers: int = 4, **kwargs) -> list[str]:
+    """
+    Runs process_chunk over many chunks concurrently. Chunks are submitted longest first,
+    so the slowest calls start early instead of running alone at the end of the batch.
+    kwargs are forwarded to process_chunk. Returns results in the original chunk order.
+    """
+    results = [None] * len(chunks)
+    if not chunks:
+        return results
+
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    with _session_thread_pool(max_workers) as executor:
+        for i, result in zip(order, executor.map(lambda i: process_chunk(chunks[i], **kwargs), order)):
+            results[i] = result
+    return results
+
 # Legacy alias removal or update if strictly needed, but better to update calls.
 # process_chunk_with_gemini = ... (Removing to encourage proper usage)
 
@@ -522,14 +862,13 @@ def analyze_toc_with_gemini(toc_text: str, google_client, model_name: str = "gem
     """
 
     try:
-        response = _generate_with_retry(
+        return _generate_text_with_retry(
             model_name, 
             prompt, 
             types.GenerateContentConfig(response_mime_type="application/json", temperature=0.1),
             google_client,
             fallback_to_flash_lite=False
         )
-        return response.text
     except Exception as e:
         logger.error(f"Error analyzing TOC: {e}")
         return "Error analyzing table of contents. Please try again."
@@ -556,17 +895,16 @@ def sort_files_with_gemini(file_names: list[str], google_client=None, openrouter
             resp_text = _generate_with_zai(model_name, system_instruction, prompt, zai_client)
         else:
             # Google
-            response = _generate_with_retry(
+            resp_text = _generate_text_with_retry(
                 model_name,
                 prompt,
                 types.GenerateContentConfig(response_mime_type="application/json", temperature=0.0),
                 google_client,
                 fallback_to_flash_lite=False
             )
-            resp_text = response.text
 
         try:
-            sorted_list = json.loads(resp_text)
+            sorted_list = _json_loads(resp_text)
         except json.JSONDecodeError:
             # Try to extract JSON from text if parsing fails
             sorted_list = extract_json_from_text(resp_text)
@@ -594,18 +932,30 @@ def generate_chapter_summary(text_chunk: str, google_client=None, openrouter_cli
             return _generate_with_zai(model_name, system_instruction, prompt, zai_client)
         else:
             # Google/Gemini
-            response = _generate_with_retry(
+            return _generate_text_with_retry(
                 model_name,
                 prompt,
                 types.GenerateContentConfig(temperature=0.2),
                 google_client,
                 fallback_to_flash_lite=True
             )
-            return response.text
     except Exception as e:
         logger.error(f"Summary generation failed: {e}")
         return "Summary generation failed. Please try again."
 
+def generate_chapter_summaries_parallel(texts: list[str], google_client=None, openrouter_client=None, zai_client=None, model_name: str = "gemma-3-27b-it", max_workers: int = 4) -> list[str]:
+    """
+    Runs generate_chapter_summary over many chapters concurrently.
+    Returns summaries in input order; the per-model rate limiter paces the requests.
+    """
+    if not texts:
+        return []
+    with _session_thread_pool(max_workers) as executor:
+        return list(executor.map(
+            lambda text: generate_chapter_summary(text, google_client=google_client, openrouter_client=openrouter_client, zai_client=zai_client, model_name=model_name),
+            texts
+        ))
+
 def generate_full_summary(chapter_summaries: list[str], google_client=None, openrouter_client=None, zai_client=None, model_name: str = "gemma-3-27b-it") -> str:
     """Aggregates chapter summaries into a document abstract. Supports Google and OpenRouter."""
     joined_summaries = "\n- ".join(chapter_summaries)
@@ -621,14 +971,13 @@ def generate_full_summary(chapter_summaries: list[str], google_client=None, open
             return _generate_with_zai(model_name, system_instruction, prompt, zai_client)
         else:
             # Google
-            response = _generate_with_retry(
+            return _generate_text_with_retry(
                 model_name,
                 prompt,
                 types.GenerateContentConfig(temperature=0.2),
                 google_client,
                 fallback_to_flash_lite=True
             )
-            return response.text
     except Exception as e:
         logger.error(f"Full summary generation failed: {e}")
         return "Full summary generation failed. Please try again."
@@ -671,14 +1020,13 @@ Rules:
             system_instruction = "You are a Document Chapter Analyzer. Output strictly valid JSON."
             resp_text = _generate_with_zai(model_name, system_instruction, prompt, zai_client)
         else:
-            response = _generate_with_retry(
+            resp_text = _generate_text_with_retry(
                 model_name,
                 prompt,
                 types.GenerateContentConfig(response_mime_type="application/json", temperature=0.1),
                 google_client,
                 fallback_to_flash_lite=True
             )
-            resp_text = response.text
             
         try:
             chapters = extract_json_from_text(resp_text)
@@ -706,13 +1054,13 @@ def extract_json_from_text(text: str) -> list:
     text = text.strip()
     
     # 1. Try to find markdown JSON block
-    match = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    match = _JSON_FENCE.search(text)
     if match:
         text = match.group(1).strip()
         
     # 2. If valid JSON, return it
     try:
-        return json.loads(text)
+        return _json_loads(text)
     except json.JSONDecodeError:
         pass
         
@@ -723,13 +1071,59 @@ def extract_json_from_text(text: str) -> list:
     if start != -1 and end != -1 and end > start:
         json_str = text[start:end+1]
         try:
-            return json.loads(json_str)
+            return _json_loads(json_str)
         except json.JSONDecodeError:
             pass
             
     return []
 
 
+def _find_title_occurrences(text: str, prefixes: list) -> list:
+    """
+    Finds all case-insensitive start offsets of each title prefix in text.
+    Returns: one sorted list of offsets per prefix.
+    """
+    occurrences = [[] for _ in prefixes]
+    groups = {}
+    for i, prefix in enumerate(prefixes):
+        groups.setdefault(prefix.lower(), []).append(i)
+
+    # Aho-Corasick scans the text once for all titles. Lowercasing must keep
+    # offsets aligned with the original text, otherwise use the regex path.
+    # The lowered copy is only made when the automaton will use it.
+    lowered = text.lower() if ahocorasick is not None and all(prefixes) else None
+    if lowered is not None and len(lowered) == len(text):
+        automaton = ahocorasick.Automaton()
+        for key, indices in groups.items():
+            automaton.add_word(key, (len(key), indices))
+        automaton.make_automaton()
+
+        for end, (length, indices) in automaton.iter(lowered):
+            for i in indices:
+                occurrences[i].append(end - length + 1)
+        return occurrences
+
+    # An empty prefix matches at every offset
+    for i in groups.pop("", []):
+        occurrences[i] = range(len(text) + 1)
+    if not groups:
+        return occurrences
+
+    # One alternation pass for all titles. Longest keys come first so each
+    # offset reports the longest match; shorter keys it starts with match there too.
+    keys = sorted(groups, key=len, reverse=True)
+    matched_at = [
+        [i for other in keys if key.startswith(other) for i in groups[other]]
+        for key in keys
+    ]
+    # Lookahead keeps overlapping matches, mirroring the automaton output
+    pattern = re.compile("(?=" + "|".join(f"({re.escape(key)})" for key in keys) + ")", re.IGNORECASE)
+    for m in pattern.finditer(text):
+        for i in matched_at[m.lastindex - 1]:
+            occurrences[i].append(m.start())
+    return occurrences
+
+
 def split_text_by_chapters(text: str, chapters: list) -> list:
     """
     Attempts to split text based on detected chapter titles.
@@ -739,29 +1133,24 @@ def split_text_by_chapters(text: str, chapters: list) -> list:
         return []
     
     # Simple heuristic: search for chapter titles in the text and split
-    import re
     chapter_splits = []
+
+    # Use first 30 chars of each title to be flexible, case-insensitive
+    titles = [chapter.get("title", "") for chapter in chapters]
+    occurrences = _find_title_occurrences(text, [title[:30] for title in titles])
     
-    for i, chapter in enumerate(chapters):
-        title = chapter.get("title", "")
-        # Try to find this title in the text
-        # Look for variations: with/without "Chapter X:", case-insensitive
-        pattern = re.escape(title[:30])  # Use first 30 chars to be flexible
-        matches = list(re.finditer(pattern, text, re.IGNORECASE))
+    for i, title in enumerate(titles):
+        matches = occurrences[i]
         
         if matches:
-            start_pos = matches[0].start()
+            start_pos = matches[0]
             # Find end position (start of next chapter or end of text)
+            end_pos = len(text)
             if i < len(chapters) - 1:
-                next_title = chapters[i + 1].get("title", "")
-                next_pattern = re.escape(next_title[:30])
-                next_matches = list(re.finditer(next_pattern, text[start_pos + 100:], re.IGNORECASE))
-                if next_matches:
-                    end_pos = start_pos + 100 + next_matches[0].start()
-                else:
-                    end_pos = len(text)
-            else:
-                end_pos = len(text)
+                next_matches = occurrences[i + 1]
+                j = bisect_left(next_matches, start_pos + 100)
+                if j < len(next_matches):
+                    end_pos = next_matches[j]
             
             chapter_splits.append({
                 "title": title,
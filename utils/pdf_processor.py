@@ -6,9 +6,17 @@ and splitting documents into manageable chunks.
 """
 
 import fitz  # PyMuPDF
+import os
 import re
 import unicodedata
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from semantic_text_splitter import TextSplitter  # Optional: Rust splitter for large texts
+except ImportError:
+    TextSplitter = None
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +24,53 @@ logger = logging.getLogger(__name__)
 DEFAULT_CHUNK_SIZE = 10000
 DEFAULT_OVERLAP = 200
 TOC_PAGE_LIMIT = 50
+PARALLEL_EXTRACT_MIN_PAGES = 64  # below this, starting worker processes costs more than it saves
+MAX_EXTRACT_WORKERS = 8
+MIN_CHUNK_CHARS = 50  # shorter chunks are merged into a neighbour (and would not be embedded on their own)
+# Plain text only: no image blocks, ligatures expanded, words hyphenated across lines rejoined
+TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_DEHYPHENATE | fitz.TEXT_MEDIABOX_CLIP
+
+_WHITESPACE = re.compile(r'\s+')
+_SENTENCE_ENDS = ('. ', '! ', '? ', '.\n', '!\n', '?\n')
+_SPLITTERS: dict = {}  # (chunk_size, overlap) -> TextSplitter
+
+def _page_text(page) -> str:
+    """Extracts the plain text of a page with TEXT_FLAGS."""
+    return page.get_text("text", flags=TEXT_FLAGS)
+
+def _extract_page_range(pdf_bytes: bytes, start: int, stop: int) -> list[str]:
+    """Worker: extracts pages [start, stop) from its own copy of the document."""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return [_page_text(page) for page in doc.pages(start, stop)]
+    finally:
+        doc.close()
+
+def _extract_pages(doc, pdf_bytes: bytes) -> list[str]:
+    """
+    Returns the text of every page. Large documents are split into page ranges
+    extracted in worker processes; MuPDF documents cannot be shared between threads.
+    Workers are spawned rather than forked: forking the multi-threaded Streamlit server
+    can deadlock on locks held by other threads. Each worker gets its own pickled copy of
+    pdf_bytes and opens the document itself, so peak memory is roughly (workers + 1) x the PDF size.
+    """
+    page_count = doc.page_count
+    workers = min(os.cpu_count() or 1, MAX_EXTRACT_WORKERS, page_count // PARALLEL_EXTRACT_MIN_PAGES)
+    if workers > 1 and not doc.is_encrypted:
+        step = -(-page_count // workers)
+        starts = list(range(0, page_count, step))
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                parts = executor.map(_extract_page_range, [pdf_bytes] * len(starts), starts,
+                                     [min(start + step, page_count) for start in starts])
+                return [text for part in parts for text in part]
+        except Exception as e:
+            logger.warning(f"Parallel page extraction failed, extracting serially: {e}")
+    return [_page_text(page) for page in doc.pages()]
+
+def _nfc(text: str) -> str:
+    """NFC-normalizes text, skipping the copy when it is already NFC (the usual case for PDF text)."""
+    return text if unicodedata.is_normalized('NFC', text) else unicodedata.normalize('NFC', text)
 
 def extract_text_from_pdf(pdf_stream) -> str:
     """
@@ -24,12 +79,10 @@ def extract_text_from_pdf(pdf_stream) -> str:
     doc = None
     try:
         pdf_stream.seek(0)  # Ensure we start from beginning
-        doc = fitz.open(stream=pdf_stream.read(), filetype="pdf")
-        text = []
-        for page in doc:
-            text.append(page.get_text())
-        raw_text = "\n".join(text)
-        return unicodedata.normalize('NFC', raw_text)
+        pdf_bytes = pdf_stream.read()
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        raw_text = "\n".join(_extract_pages(doc, pdf_bytes))
+        return _nfc(raw_text)
     except Exception as e:
         raise ValueError(f"Error reading PDF: {e}")
     finally:
@@ -48,10 +101,10 @@ def get_pdf_front_matter(pdf_stream, page_limit: int = 50) -> str:
         doc = fitz.open(stream=pdf_stream.read(), filetype="pdf")
         text = []
         limit = min(page_limit, doc.page_count)
-        for i in range(limit):
-            text.append(doc.load_page(i).get_text())
+        for page in doc.pages(0, limit):
+            text.append(_page_text(page))
         raw_text = "\n".join(text)
-        return unicodedata.normalize('NFC', raw_text)
+        return _nfc(raw_text)
     except Exception as e:
         return ""
     finally:
@@ -77,7 +130,8 @@ def extract_chapters_from_pdf(pdf_stream, ai_extracted_toc: list = None) -> list
 
     try:
         pdf_stream.seek(0)
-        doc = fitz.open(stream=pdf_stream.read(), filetype="pdf")
+        pdf_bytes = pdf_stream.read()
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
 
         toc = []
         if ai_extracted_toc:
@@ -95,10 +149,7 @@ def extract_chapters_from_pdf(pdf_stream, ai_extracted_toc: list = None) -> list
 
         # If no TOC, return entire doc as one chapter
         if not toc:
-            text = []
-            for page in doc:
-                text.append(page.get_text())
-            return [{"title": "Full Document", "text": "\n".join(text)}]
+            return [{"title": "Full Document", "text": "\n".join(_extract_pages(doc, pdf_bytes))}]
 
         chapters = []
         page_count = doc.page_count
@@ -106,6 +157,9 @@ def extract_chapters_from_pdf(pdf_stream, ai_extracted_toc: list = None) -> list
         # Calculate offset for Roman numeral prefaces
         pdf_offset = get_page_offset(doc)
 
+        # Extract every page once; pages shared by adjacent chapters are not re-extracted
+        page_texts = _extract_pages(doc, pdf_bytes)
+
         for i in range(len(toc)):
             item = toc[i]
             level = item[0]
@@ -141,15 +195,10 @@ def extract_chapters_from_pdf(pdf_stream, ai_extracted_toc: list = None) -> list
             # However, precise text extraction per coordinate is hard.
             # We will grab the whole page logic for now as it's standard for this level of granularity.
 
-            chapter_text_list = []
-            if p_start <= p_end:
-                for p_idx in range(p_start, p_end + 1):
-                    chapter_text_list.append(doc.load_page(p_idx).get_text())
-
-            raw_text = "\n".join(chapter_text_list)
+            raw_text = "\n".join(page_texts[p_start:p_end + 1])
             chapters.append({
                 "title": title,
-                "text": unicodedata.normalize('NFC', raw_text)
+                "text": _nfc(raw_text)
             })
 
         return chapters
@@ -173,18 +222,25 @@ def clean_text(text: str) -> str:
     # For LLM processing, single spaces are usually fine unless strict formatting is needed.
     # However, Medical texts might have tables or lists.
     # Let's stick to simple normalization for now.
-    text = re.sub(r'\s+', ' ', text)
+    text = _WHITESPACE.sub(' ', text)
     return text.strip()
 
 def recursive_character_text_splitter(text: str, chunk_size: int = 10000, overlap: int = 200) -> list[str]:
     """
-    Splits text into chunks of approximately chunk_size with overlap.
+    Splits text into chunks of at most chunk_size characters with overlap.
     Tries to split on sentence boundaries or spaces.
     """
     if len(text) <= chunk_size:
         return [text]
 
-    chunks = []
+    if TextSplitter is not None and 0 <= overlap < chunk_size:
+        splitter = _SPLITTERS.get((chunk_size, overlap))
+        if splitter is None:
+            splitter = _SPLITTERS[(chunk_size, overlap)] = TextSplitter(chunk_size, overlap=overlap)
+        spans = [(offset, offset + len(chunk)) for offset, chunk in splitter.chunk_indices(text)]
+        return [text[s:e] for s, e in _merge_small_spans(spans, chunk_size)]
+
+    spans = []
     start = 0
     text_len = len(text)
 
@@ -192,7 +248,7 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 10000, overla
         end = min(start + chunk_size, text_len)
         
         if end == text_len:
-            chunks.append(text[start:end])
+            spans.append((start, end))
             break
 
         # Try to find a suitable split point
@@ -203,12 +259,12 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 10000, overla
         search_start = max(start, end - lookback)
         chunk_window = text[search_start:end]
 
-        # Regex for sentence ending
-        sentence_end = list(re.finditer(r'[.!?]\s', chunk_window))
+        # Last sentence ending in the window (str.rfind scans backwards in C)
+        last_sentence = max(chunk_window.rfind(end_mark) for end_mark in _SENTENCE_ENDS)
         
         split_point = -1
-        if sentence_end:
-            split_point = search_start + sentence_end[-1].end()
+        if last_sentence != -1:
+            split_point = search_start + last_sentence + 2
         else:
             # Fallback: look for space
             last_space = chunk_window.rfind(' ')
@@ -219,7 +275,7 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 10000, overla
             # If no good split point found, force split at max size
             split_point = end
         
-        chunks.append(text[start:split_point])
+        spans.append((start, split_point))
         
         # Move start pointer, accounting for overlap
         # The next chunk starts at split_point - overlap
@@ -232,4 +288,21 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 10000, overla
             
         start = next_start
 
-    return chunks
+    return [text[s:e] for s, e in _merge_small_spans(spans, chunk_size)]
+
+def _merge_small_spans(spans: list[tuple[int, int]], chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Merges chunk spans shorter than MIN_CHUNK_CHARS (typically the tail of a text)
+    into the preceding span, as long as the result stays within chunk_size.
+    Spans are (start, end) offsets, so overlapping text is not duplicated.
+    """
+    merged = []
+    for start, end in spans:
+        if merged:
+            prev_start, prev_end = merged[-1]
+            tiny = end - start < MIN_CHUNK_CHARS or prev_end - prev_start < MIN_CHUNK_CHARS
+            if tiny and end - prev_start <= chunk_size:
+                merged[-1] = (prev_start, end)
+                continue
+        merged.append((start, end))
+    return merged
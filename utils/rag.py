@@ -7,15 +7,58 @@ in-memory cache for fast vector similarity search.
 
 import sqlite3
 import json
+import hashlib
 import numpy as np
 import logging
-import os
+import threading
+import weakref
 from typing import List, Dict, Optional
-from utils.llm_handler import get_embedding, MAX_VECTOR_STORE_CHUNKS, MIN_CHUNK_LENGTH
+from utils.llm_handler import get_embedding, get_embeddings, MAX_VECTOR_STORE_CHUNKS, MIN_CHUNK_LENGTH
+
+try:
+    import orjson  # Optional: faster metadata encoding/decoding
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so the load loop's except clause still applies
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+def _json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson is not None else json.dumps(obj)
+
 DB_PATH = "vector_store.db"
+SQLITE_PRAGMAS = (
+    "PRAGMA page_size=8192",  # Only applies to new databases; must precede WAL. Fits 1536-dim embeddings without overflow pages
+    "PRAGMA journal_mode=WAL",  # Readers are not blocked by writes; commits append to the log
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL; skips the fsync on every commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",  # KiB, i.e. 64 MiB of page cache
+)
+
+def _normalize(vec: np.ndarray) -> np.ndarray:
+    """Returns vec scaled to unit length (zero vectors are returned unchanged)."""
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def _normalize_rows(matrix: np.ndarray) -> None:
+    """Scales each row of matrix to unit length in place (zero rows are left as is)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+
+def _text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    if len(scores) > k:
+        # O(N) selection of the k best, then sort only those
+        idx = np.argpartition(-scores, k)[:k]
+        return idx[np.argsort(-scores[idx])]
+    return np.argsort(-scores)
 
 class SQLiteVectorStore:
     """
@@ -23,20 +66,38 @@ class SQLiteVectorStore:
     
     Attributes:
         db_path: Path to the SQLite database file.
-        chunks: In-memory cache of chunks for fast search.
+        chunks: In-memory cache of chunk texts and metadata.
     """
     
     def __init__(self, db_path: str = DB_PATH):
         """Initialize database connection and load cache."""
         self.db_path = db_path
+        self._lock = threading.Lock()  # The connection is shared across Streamlit threads
+        self._conn = self._connect()
         self._init_db()
         self.chunks: List[Dict] = []
+        # L2-normalized embedding rows (same order as chunks) in one contiguous float32 matrix with spare capacity
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._count = 0
+        self._text_hashes: set = set()  # SHA-256 of every stored text, to skip re-adding the same chunk
         self._load_cache()
         
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Open the store's single long-lived connection."""
+        try:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            weakref.finalize(self, conn.close)
+            return conn
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open vector DB: {e}")
+            return None
+
     def _init_db(self) -> None:
         """Create tables if they don't exist."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._lock, self._conn as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS chunks (
@@ -46,40 +107,48 @@ class SQLiteVectorStore:
                         embedding BLOB NOT NULL
                     )
                 """)
-                conn.commit()
         except Exception as e:
             logger.error(f"Failed to initialize vector DB: {e}")
 
     def _load_cache(self) -> None:
         """Load all chunks from DB into memory."""
-        conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT text, metadata, embedding FROM chunks")
-            rows = cursor.fetchall()
+            with self._lock:
+                cursor = self._conn.cursor()
+                total = cursor.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+                cursor.execute("SELECT text, metadata, embedding FROM chunks ORDER BY id")
 
-            self.chunks = []
-            for text, meta_json, emb_blob in rows:
-                try:
-                    embedding = np.frombuffer(emb_blob, dtype=np.float32)
-                    metadata = json.loads(meta_json) if meta_json else {}
-                    self.chunks.append({
-                        "text": text,
-                        "metadata": metadata,
-                        "embedding": embedding
-                    })
-                except (ValueError, json.JSONDecodeError) as load_err:
-                    logger.warning(f"Skipping corrupted chunk: {load_err}")
+                self.chunks = []
+                self._text_hashes = set()
+                self._reset_matrix()
+                for text, meta_json, emb_blob in cursor:
+                    try:
+                        embedding = np.frombuffer(emb_blob, dtype=np.float32)
+                        if not embedding.size:
+                            raise ValueError("empty embedding")
+                        if not self._matrix.size:
+                            # Sized from the row count and first BLOB, so rows are copied straight into place
+                            self._matrix = np.empty((total, embedding.size), dtype=np.float32)
+                        elif embedding.size != self._matrix.shape[1]:
+                            raise ValueError(f"embedding size {embedding.size} != {self._matrix.shape[1]}")
+                        metadata = _json_loads(meta_json) if meta_json else {}
+                        self._matrix[self._count] = embedding
+                        self._count += 1
+                        self.chunks.append({
+                            "text": text,
+                            "metadata": metadata
+                        })
+                        self._text_hashes.add(_text_hash(text))
+                    except (ValueError, json.JSONDecodeError) as load_err:
+                        logger.warning(f"Skipping corrupted chunk: {load_err}")
+            # New rows are persisted normalized; this only rescales rows written by older versions
+            _normalize_rows(self._matrix[:self._count])
 
             logger.info(f"Loaded {len(self.chunks)} chunks from persistence.")
         except sqlite3.Error as e:
             logger.error(f"Database error loading vector cache: {e}")
         except Exception as e:
             logger.error(f"Failed to load vector cache: {e}")
-        finally:
-            if conn:
-                conn.close()
 
     def add_chunks(self, chunks: List[str], google_client, zai_client=None, metadata_list: List[Dict] = None) -> None:
         """Add chunks to DB and cache."""
@@ -96,47 +165,90 @@ class SQLiteVectorStore:
             metadata_list = metadata_list[:remaining_slots]
 
         new_entries = []
-        
+        new_chunks = []
+        stored_indices = []
+        new_vectors = []
+        encoded_metadata = {}  # id(dict) -> JSON; callers usually pass one shared dict per document
+        dim = self._matrix.shape[1] if self._count else None
+        # Skip texts already stored or repeated in this batch before paying for their embeddings
+        hashes = {}
+        batch_hashes = set()
         for i, text in enumerate(chunks):
-            if len(text) < MIN_CHUNK_LENGTH: 
-                continue
-                
-            emb = get_embedding(text, google_client=google_client, zai_client=zai_client) 
+            if len(text) >= MIN_CHUNK_LENGTH:
+                text_hash = _text_hash(text)
+                if text_hash not in self._text_hashes and text_hash not in batch_hashes:
+                    batch_hashes.add(text_hash)
+                    hashes[i] = text_hash
+        valid_indices = list(hashes)
+        # One batched call for all new chunks
+        embeddings = get_embeddings([chunks[i] for i in valid_indices], google_client=google_client, zai_client=zai_client)
+
+        for i, emb in zip(valid_indices, embeddings):
             if emb:
+                text = chunks[i]
                 embedding_np = np.array(emb, dtype=np.float32)
+                if dim is None:
+                    dim = embedding_np.shape[0]
+                elif embedding_np.shape[0] != dim:
+                    logger.warning(f"Skipping chunk with embedding size {embedding_np.shape[0]} (store uses {dim})")
+                    continue
+                embedding_np = _normalize(embedding_np)
                 metadata = metadata_list[i]
+                if id(metadata) not in encoded_metadata:
+                    # Empty metadata is stored as NULL, which loads without a JSON parse
+                    encoded_metadata[id(metadata)] = _json_dumps(metadata) if metadata else None
                 
                 new_entries.append((
                     text,
-                    json.dumps(metadata),
+                    encoded_metadata[id(metadata)],
                     embedding_np.tobytes()
                 ))
                 
-                # Update cache
-                self.chunks.append({
+                new_chunks.append({
                     "text": text,
-                    "metadata": metadata,
-                    "embedding": embedding_np
+                    "metadata": metadata
                 })
+                new_vectors.append(embedding_np)
+                stored_indices.append(i)
+
+        # Update cache in one step: one matrix copy for the whole batch
+        self.chunks.extend(new_chunks)
+        self._append_vectors(new_vectors)
+        self._text_hashes.update(hashes[i] for i in stored_indices)
 
         # Bulk insert to DB
         if new_entries:
-            conn = None
             try:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                cursor.executemany(
-                    "INSERT INTO chunks (text, metadata, embedding) VALUES (?, ?, ?)",
-                    new_entries
-                )
-                conn.commit()
+                with self._lock, self._conn as conn:
+                    conn.executemany(
+                        "INSERT INTO chunks (text, metadata, embedding) VALUES (?, ?, ?)",
+                        new_entries
+                    )
             except sqlite3.Error as e:
                 logger.error(f"Database error persisting chunks: {e}")
             except Exception as e:
                 logger.error(f"Failed to persist chunks: {e}")
-            finally:
-                if conn:
-                    conn.close()
+
+    def _reset_matrix(self) -> None:
+        """Drop all in-memory embedding rows."""
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._count = 0
+
+    def _append_vectors(self, vectors: List[np.ndarray]) -> None:
+        """Copy (normalized) embeddings into the search matrix, doubling its capacity when full."""
+        if not vectors:
+            return
+        block = np.vstack(vectors).astype(np.float32, copy=False)
+        needed = self._count + len(block)
+        if needed > self._matrix.shape[0]:
+            # Doubling keeps copies amortized O(1); never reserve past the store's capacity
+            capacity = max(needed, min(2 * self._matrix.shape[0], MAX_VECTOR_STORE_CHUNKS))
+            grown = np.empty((capacity, block.shape[1]), dtype=np.float32)
+            if self._count:
+                grown[:self._count] = self._matrix[:self._count]
+            self._matrix = grown
+        self._matrix[self._count:needed] = block
+        self._count = needed
 
     def search(self, query: str, google_client, zai_client=None, k: int = 5) -> List[Dict]:
         """Search similar chunks using in-memory cache."""
@@ -148,44 +260,75 @@ class SQLiteVectorStore:
             return []
             
         q_vec = np.array(query_emb, dtype=np.float32)
-        q_norm = np.linalg.norm(q_vec)
+        q_norm = np.sqrt(np.vdot(q_vec, q_vec))
         
         if q_norm == 0:
             return []
         
-        # Vectorized cosine similarity
-        embeddings_matrix = np.array([c["embedding"] for c in self.chunks], dtype=np.float32)
-        dot_products = np.dot(embeddings_matrix, q_vec)
-        norms = np.linalg.norm(embeddings_matrix, axis=1)
-        norms[norms == 0] = 1e-10
-        scores = dot_products / (norms * q_norm)
-        
-        top_indices = np.argsort(scores)[::-1][:k]
+        if q_vec.shape[0] != self._matrix.shape[1]:
+            return []  # Embedding model changed
+
+        # Rows are unit vectors, so cosine similarity is a single matrix-vector product
+        q_vec /= q_norm
+        scores = self._matrix[:self._count] @ q_vec
         
-        return [self.chunks[i] for i in top_indices]
+        return [self.chunks[i] for i in _top_k(scores, k)]
+
+    def search_batch(self, queries: List[str], google_client, zai_client=None, k: int = 5) -> List[List[Dict]]:
+        """Search several queries at once: one batched embedding call and one matrix product."""
+        results = [[] for _ in queries]
+        if not self.chunks or not queries:
+            return results
+
+        embeddings = get_embeddings(queries, google_client=google_client, zai_client=zai_client)
+        dim = self._matrix.shape[1]
+        # Queries that failed to embed or came from a different model get no results
+        valid = [i for i, emb in enumerate(embeddings) if len(emb) == dim]
+        if not valid:
+            return results
+
+        q_mat = np.array([embeddings[i] for i in valid], dtype=np.float32)
+        q_norms = np.linalg.norm(q_mat, axis=1)
+        nonzero = q_norms > 0
+        valid = [i for i, ok in zip(valid, nonzero) if ok]
+        q_mat = q_mat[nonzero] / q_norms[nonzero, None]
+        # One GEMM instead of a GEMV per query
+        scores = q_mat @ self._matrix[:self._count].T
+
+        for row, i in enumerate(valid):
+            results[i] = [self.chunks[j] for j in _top_k(scores[row], k)]
+        return results
         
     def clear(self) -> None:
         """Clear DB and cache."""
-        conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM chunks")
-            conn.commit()
-            self.chunks = []
-            if os.path.exists(self.db_path):
+            with self._lock:
+                with self._conn as conn:
+                    conn.execute("DELETE FROM chunks")
+                self.chunks = []
+                self._text_hashes = set()
+                self._reset_matrix()
                 try:
                     # Vacuum to reclaim space
-                    conn.execute("VACUUM")
+                    self._conn.execute("VACUUM")
                 except sqlite3.Error:
                     pass
         except sqlite3.Error as e:
             logger.error(f"Database error clearing vector store: {e}")
         except Exception as e:
             logger.error(f"Failed to clear vector store: {e}")
-        finally:
-            if conn:
-                conn.close()
+
+    def close(self) -> None:
+        """Close the database connection."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self) -> "SQLiteVectorStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
     def __len__(self) -> int:
         return len(self.chunks)